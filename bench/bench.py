@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+'''
+Offline benchmarks for FeedstoKobo.
+
+Replays generated RSS/Atom feeds and substack posts from a loopback
+http server and runs the cache, DoPocket, DoSubstack and DoDropbox
+against stubs of Pocket, Dropbox and the webdriver (see stubs.py), so
+nothing leaves the machine. Needs the same packages as FeedstoKobo
+itself; PDFs are rendered with wkhtmltopdf if it is installed and
+faked otherwise.
+
+    python3 bench/bench.py
+    python3 bench/bench.py --only cache --sizes 1000 1000000 --json bench.jsonl
+
+Each result is printed and, with --json, appended as a json line
+(tagged with the git revision) so runs can be compared over time.
+'''
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+import functools
+import statistics
+import subprocess
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(_here), 'src'))
+
+# pylint: disable=wrong-import-position
+import kobo.render
+import kobo.dosubstack
+from kobo.options import buildparser
+from kobo.cache import Cache
+from kobo.sqlitecache import SqliteCache
+from kobo.pocket import DoPocket
+from kobo.dosubstack import DoSubstack
+from kobo.dropbox import DoDropbox
+from kobo.instrument import metrics
+from kobo.pipeline import Pipeline
+from kobo.util import hashstring
+from stubs import FixtureServer, StubPocket, StubDropbox, FakeDriverPool, rss, atom, post
+
+try:
+    import feedparser
+except ImportError as msg:
+    print("Error loading pacakge %s" , str(msg))
+    sys.exit()
+
+logger = logging.getLogger('bench')
+
+def options(workdir, **overrides):
+    '''Default command line options with everything stored below workdir.'''
+    opts = buildparser().parse_args([])
+    opts.cachedir = opts.logdir = opts.configdir = workdir
+    for _key, _val in overrides.items():
+        setattr(opts, _key, _val)
+    return opts
+
+def percentiles(samples):
+    '''mean, p50 and p95 of samples in microseconds.'''
+    samples = sorted(samples)
+    return {'mean_us': round(statistics.mean(samples) * 1e6, 2),
+            'p50_us': round(samples[len(samples)//2] * 1e6, 2),
+            'p95_us': round(samples[int(len(samples)*0.95)] * 1e6, 2)}
+
+def timed(func, *args, **kwargs):
+    '''Return (seconds, result) of a call.'''
+    _start = time.perf_counter()
+    _res = func(*args, **kwargs)
+    return time.perf_counter() - _start, _res
+
+def bench_cache(workdir, sizes, backends, lookups=10000, feeds=100):
+    '''Fill, save, load and query caches of sizes links.'''
+    for _backend in backends:
+        for _size in sizes:
+            _dir = tempfile.mkdtemp(dir=workdir)
+            opts = options(_dir, compactlinks=_backend == 'compact')
+            _cls = SqliteCache if _backend == 'sqlite' else Cache
+            cache = _cls(opts)
+            _links = {hashstring('feed%s' % _f): ['https://example%s.com/p/%s' % (_f, _i)
+                for _i in range(_size // feeds)] for _f in range(feeds)}
+            _fill, _ = timed(lambda: [cache.set(_urls, 'links', _key)
+                for _key, _urls in _links.items()])
+            _save, _ = timed(cache.compact)
+            _load, cache = timed(_cls, opts)
+            _keys = list(_links)
+            _hits, _misses = [], []
+            for _i in range(lookups):
+                _key = _keys[_i % feeds]
+                _url = _links[_key][random.randrange(len(_links[_key]))] \
+                    if _links[_key] else 'none'
+                _hits.append(timed(cache.has, _url, 'links', _key)[0])
+                _misses.append(timed(cache.has, _url+'/new', 'links', _key)[0])
+            _append, _ = timed(lambda: [cache.append_unique(
+                'https://example.com/new/%s' % _i, 'links', _keys[_i % feeds])
+                for _i in range(1000)])
+            _journal, _ = timed(cache.save)
+            _bytes = os.path.getsize(cache.db_fn if _cls is SqliteCache else cache.cache_fn)
+            yield {'bench': 'cache', 'backend': _backend, 'links': _size, 'bytes': _bytes,
+                   'fill_s': round(_fill, 3), 'save_s': round(_save, 3),
+                   'load_s': round(_load, 3),
+                   'has_hit': percentiles(_hits), 'has_miss': percentiles(_misses),
+                   'has_per_s': int(2 * lookups / (sum(_hits) + sum(_misses))),
+                   'append_1k_s': round(_append, 3), 'save_1k_s': round(_journal, 3)}
+            shutil.rmtree(_dir)
+
+def feeditems(host, name, count, start=0):
+    '''(guid, link, title, date) of count posts, newest first.'''
+    _now = datetime.datetime(2021, 6, 1)
+    return [('%s-%s' % (name, _i), 'http://%s/post/%s/%s' % (host, name, _i),
+             'Post %s of %s' % (_i, name), _now + datetime.timedelta(hours=_i))
+            for _i in range(start + count - 1, start - 1, -1)]
+
+def bench_pocket(workdir, server, entries, feeds=10, latency=0.0, new=5):
+    '''rsstopocket on feeds of entries items: a cold run, a run where
+       nothing changed and a run with new posts at the top of each feed.'''
+    for _count in entries:
+        _dir = tempfile.mkdtemp(dir=workdir)
+        opts = options(_dir)
+        _names = ['rss%s-%s' % (_count, _f) for _f in range(feeds)]
+        for _f, _name in enumerate(_names):
+            _doc = rss if _f % 2 else atom
+            server.add('/feeds/%s.xml' % _name,
+                _doc(_name, 'http://%s/' % server.host, feeditems(server.host, _name, _count)),
+                'application/xml')
+        cache = Cache(opts)
+        pocket = DoPocket(cache, opts,
+            {'USEROPTS': {'CONSUMER_KEY': 'bench', 'ACCESS_TOKEN': 'bench'}})
+        pocket.pocket_instance = StubPocket(latency)
+        pocket.fetcher.fetch = functools.partial(pocket.fetcher.fetch, scheme='http://')
+        _feeds = ['%s/feeds/%s.xml' % (server.host, _name) for _name in _names]
+        metrics.reset()
+        _requests = server.requests
+        _cold, _sent = timed(pocket.rsstopocket, _feeds)
+        _cold_requests = server.requests - _requests
+        _warm, _ = timed(pocket.rsstopocket, _feeds)
+        for _f, _name in enumerate(_names):
+            _doc = rss if _f % 2 else atom
+            server.add('/feeds/%s.xml' % _name,
+                _doc(_name, 'http://%s/' % server.host,
+                    feeditems(server.host, _name, _count + new)), 'application/xml')
+        _incr, _added = timed(pocket.rsstopocket, _feeds)
+        yield {'bench': 'pocket', 'feeds': feeds, 'entries': _count,
+               'cold_s': round(_cold, 3),
+               'cold_entries_per_s': int(feeds * _count / _cold),
+               'cold_sent': _sent.count(True), 'cold_http_requests': _cold_requests,
+               'pocket_calls': pocket.pocket_instance.calls,
+               'unchanged_s': round(_warm, 3),
+               'new_s': round(_incr, 3), 'new_sent': _added.count(True),
+               'metrics': metrics.summary()}
+        pocket.checker.close()
+        shutil.rmtree(_dir)
+
+def bench_substack(workdir, server, entries, substacks=4, latency=0.0, browser=False, html=None):
+    '''parse_ss_entry on substacks with entries public posts, over plain
+       HTTP or (browser=True) in the fake webdriver. The html files that
+       were written are appended to html.'''
+    _parse = feedparser.parse
+    # parse_ss_entry always asks for https://<domain>/feed
+    kobo.dosubstack.feedparser = types.SimpleNamespace(
+        parse=lambda url, **kwargs: _parse(url.replace('https://', 'http://', 1), **kwargs))
+    for _count in entries:
+        _dir = tempfile.mkdtemp(dir=workdir)
+        opts = options(_dir, browseronly=browser)
+        _config = {'USEROPTS': {'HTMLROOT': _dir, 'HTTPPROXY': '',
+                                'PUSHOVERDEVICE': '', 'SSLOGIN': '', 'SSPASS': ''}}
+        _entries = []
+        for _s in range(substacks):
+            _name = 'ss%s-%s' % (_count, _s)
+            _items = [('%s-%s' % (_name, _i), 'http://%s/%s/p/%s-%s' % (server.host, _name, _name, _i),
+                       'Post %s' % _i, datetime.datetime(2021, 6, 1) + datetime.timedelta(hours=_i))
+                      for _i in range(_count - 1, -1, -1)]
+            server.add('/%s/feed' % _name, rss(_name, 'http://%s/%s' % (server.host, _name),
+                _items), 'application/xml')
+            for _, _link, _title, _ in _items:
+                server.add('/%s/p/%s' % (_name, _link.split('/')[-1]), post(_title))
+            _entries.append({'domain': '%s/%s' % (server.host, _name), 'fontsize': '32',
+                             'login': '', 'password': '', 'subdir': _name})
+        cache = Cache(opts)
+        _pool = FakeDriverPool(server, latency)
+        substack = DoSubstack(opts, _config, cache, driverpool=_pool)
+        metrics.reset()
+        _start = time.perf_counter()
+        _pdfs = []
+        for _entry in _entries:
+            _pdfs += [_uri for _, _uri, _ in substack.parse_ss_entry(_entry) if _uri]
+        _elapsed = time.perf_counter() - _start
+        _again, _ = timed(lambda: [substack.parse_ss_entry(_entry) for _entry in _entries])
+        substack.httpfetch.close()
+        yield {'bench': 'substack', 'mode': 'browser' if browser else 'http',
+               'substacks': substacks, 'entries': _count,
+               'cold_s': round(_elapsed, 3), 'posts': len(_pdfs),
+               'posts_per_s': int(len(_pdfs) / _elapsed),
+               'browser_pages': sum(_driver.pages for _driver in _pool.drivers.values()),
+               'cached_s': round(_again, 3), 'metrics': metrics.summary()}
+        if html is not None:
+            html += _pdfs
+    kobo.dosubstack.feedparser = feedparser
+
+def fakepdf(uri, pdf_fn, options=None): #pylint: disable=unused-argument
+    '''Stand-in for pdfkit.from_file when wkhtmltopdf is not installed.'''
+    with open(uri, 'rb') as _src, open(pdf_fn, 'wb') as _dst:
+        _html = _src.read()
+        _dst.write(b'%PDF-1.4\n' + _html * (1 + 8192 // max(1, len(_html))))
+
+def bench_dropbox(workdir, html, latency=0.0, renderers=2, uploaders=2, old=500):
+    '''Render and upload html files twice (the second pass finds them
+       unchanged) and prune old files twice (listing, then manifest only).'''
+    _dir = tempfile.mkdtemp(dir=workdir)
+    opts = options(_dir, renderers=renderers, uploaders=uploaders)
+    cache = Cache(opts)
+    _config = {'USEROPTS': {'DBACCESS': 'bench', 'DBREMOTEDIR': '/Apps/Kobo'}}
+    if shutil.which('wkhtmltopdf') is None:
+        kobo.render.pdfkit = types.SimpleNamespace(from_file=fakepdf)
+        _renderer = 'fake'
+    else:
+        _renderer = 'wkhtmltopdf'
+    box = DoDropbox(opts, _config, cache)
+    box.dbx = StubDropbox(latency)
+    def _pipeline():
+        # The render and upload stages of the substack pipeline in main
+        _stages = Pipeline(opts.queuesize)
+        _stages.stage('render', lambda _fn: [(_fn,
+            box.renderer.render(_fn, DoDropbox.PDFOPTIONS, '32'))], renderers)
+        _stages.stage('upload', lambda _item: [box.upload(*_item)], uploaders)
+        return _stages.run(html)
+    metrics.reset()
+    _upload, _results = timed(_pipeline)
+    _bytes, _calls = box.dbx.bytes, box.dbx.calls
+    _again, _ = timed(_pipeline)
+    _stale = datetime.datetime.utcnow().replace(microsecond=0) - datetime.timedelta(days=30)
+    for _i in range(old):
+        box.dbx.store('/Apps/Kobo/old-%s.pdf' % _i, b'%PDF-1.4 old', _stale)
+    _listed, _ = timed(box.prunedropbox, 7)
+    for _i in range(old):
+        cache.set({'name': 'old-%s.pdf' % _i, 'path': '/Apps/Kobo/old-%s.pdf' % _i,
+                   'server_modified': _stale.strftime('%Y-%m-%d %H:%M:%S'), 'content_hash': ''},
+                  'dropbox', 'files', '/apps/kobo/old-%s.pdf' % _i)
+        box.dbx.store('/Apps/Kobo/old-%s.pdf' % _i, b'%PDF-1.4 old', _stale)
+    _manifest, _ = timed(box.prunedropbox, 7)
+    box.cleanup()
+    yield {'bench': 'dropbox', 'renderer': _renderer, 'files': len(html),
+           'renderers': renderers, 'uploaders': uploaders,
+           'upload_s': round(_upload, 3), 'uploaded': _results.count(True),
+           'files_per_s': round(len(html) / _upload, 1),
+           'mb_per_s': round(_bytes / 1024 / 1024 / _upload, 2), 'api_calls': _calls,
+           'unchanged_s': round(_again, 3),
+           'prune_listing_s': round(_listed, 3), 'prune_manifest_s': round(_manifest, 3),
+           'pruned': old, 'metrics': metrics.summary()}
+    shutil.rmtree(_dir)
+
+# Modules a cache maintenance command must not import
+HEAVY = ('selenium', 'dropbox', 'pdfkit', 'feedparser', 'pocket', 'pushover', 'requests')
+
+STARTUP = '''
+import sys, json
+sys.argv[0] = 'feedstokobo'
+import kobo
+try:
+    kobo.main()
+finally:
+    print(json.dumps(sorted(_mod for _mod in %r if _mod in sys.modules)))
+''' % (HEAVY,)
+
+def bench_startup(workdir, budget, repeat=5):
+    '''Time the cache maintenance commands from a cold interpreter and
+       check that they stay within budget ms and import none of HEAVY.'''
+    _dir = os.path.join(workdir, 'startup')
+    os.makedirs(_dir)
+    _conf = os.path.join(os.path.dirname(_here), 'src', 'kobo', 'template.conf')
+    with open(_conf) as _fh:
+        _template = _fh.read()
+    with open(os.path.join(_dir, 'kobo.conf'), 'w') as _fh:
+        _fh.write(_template.replace('MY_HOME_DIR/.cache', _dir))
+    _env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.join(os.path.dirname(_here), 'src')]
+        + [_path for _path in os.environ.get('PYTHONPATH', '').split(os.pathsep) if _path]))
+    for _command in ('dedupe', 'clean'):
+        _times = []
+        for _ in range(repeat):
+            _start = time.perf_counter()
+            _res = subprocess.run([sys.executable, '-c', STARTUP, _command,
+                '--configdir', _dir, '--cachedir', _dir, '--logdir', _dir, '--cacheonly'],
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, env=_env, check=True)
+            _times.append(time.perf_counter() - _start)
+        _heavy = json.loads(_res.stdout.decode().strip().splitlines()[-1])
+        _ms = round(statistics.median(_times) * 1000, 1)
+        yield {'bench': 'startup', 'command': _command, 'median_ms': _ms,
+               'budget_ms': budget, 'heavy_imports': ','.join(_heavy) or None,
+               'ok': _ms <= budget and not _heavy}
+    shutil.rmtree(_dir)
+
+def revision():
+    '''Short git revision of the tree, if any.'''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_here,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+            ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def show(result):
+    '''Print a result on one line, without the metrics.'''
+    print('  '.join('%s=%s' % (_key, _val) for _key, _val in result.items()
+        if _key != 'metrics'))
+    sys.stdout.flush()
+
+def main():
+    '''Run the benchmarks.'''
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='*',
+        choices=['startup', 'cache', 'pocket', 'substack', 'dropbox'],
+        default=['startup', 'cache', 'pocket', 'substack', 'dropbox'],
+        help="Benchmarks to run.")
+    parser.add_argument('--sizes', nargs='*', type=int,
+        default=[1000, 10000, 100000, 1000000],
+        help="Number of links in the cache benchmarks.")
+    parser.add_argument('--backends', nargs='*', choices=['json', 'compact', 'sqlite'],
+        default=['json', 'compact', 'sqlite'],
+        help="Cache backends to benchmark (compact is json with --compactlinks).")
+    parser.add_argument('--entries', nargs='*', type=int, default=[10, 100, 1000],
+        help="Entries per feed in the pocket and substack benchmarks.")
+    parser.add_argument('--latency', type=float, default=0.0,
+        help="Seconds each stubbed API call or browser page load takes.")
+    parser.add_argument('--budget', type=float, default=300,
+        help="Milliseconds a cache maintenance command may take to start and finish.")
+    parser.add_argument('--json', metavar='FILE',
+        help="Append the results as json lines to FILE.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="Show the log of FeedstoKobo.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    random.seed(0)
+    _workdir = tempfile.mkdtemp(prefix='kobo-bench-')
+    _meta = {'revision': revision(), 'date': datetime.datetime.now().isoformat(),
+             'latency': args.latency}
+    _out = open(args.json, 'at') if args.json else None
+    _failed = False
+    try:
+        with FixtureServer() as server:
+            _benches = []
+            _html = []
+            if 'startup' in args.only:
+                _benches.append(bench_startup(_workdir, args.budget))
+            if 'cache' in args.only:
+                _benches.append(bench_cache(_workdir, args.sizes, args.backends))
+            if 'pocket' in args.only:
+                _benches.append(bench_pocket(_workdir, server, args.entries,
+                    latency=args.latency))
+            if 'substack' in args.only or 'dropbox' in args.only:
+                _benches.append(bench_substack(_workdir, server, args.entries[:2],
+                    latency=args.latency, html=_html))
+                _benches.append(bench_substack(_workdir, server, args.entries[:2],
+                    latency=args.latency, browser=True))
+            for _bench in _benches:
+                for _result in _bench:
+                    _failed = _failed or _result.get('ok') is False
+                    show(_result)
+                    if _out is not None:
+                        _out.write(json.dumps(dict(_meta, **_result))+'\n')
+            if 'dropbox' in args.only:
+                for _result in bench_dropbox(_workdir, _html,
+                        latency=args.latency):
+                    show(_result)
+                    if _out is not None:
+                        _out.write(json.dumps(dict(_meta, **_result))+'\n')
+    finally:
+        if _out is not None:
+            _out.close()
+        shutil.rmtree(_workdir, ignore_errors=True)
+    if _failed:
+        sys.exit("A cache maintenance command went over the startup budget "
+                 "or imported a client library.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+'''
+Offline stand-ins for the services FeedstoKobo talks to: a local http
+server with recorded feeds and posts, and stubs for the Pocket client,
+the Dropbox client and the Firefox webdriver.
+'''
+
+import sys
+import time
+import hashlib
+import datetime
+import threading
+import http.server
+import urllib.parse
+from email.utils import format_datetime
+
+from kobo.httpfetch import ArticleParser
+
+try:
+    import dropbox
+    from selenium.webdriver.common.by import By
+    from selenium.common.exceptions import NoSuchElementException
+except ImportError as msg:
+    print("Error loading pacakge %s" , str(msg))
+    sys.exit()
+
+PARAGRAPH = '<p>%s</p>' % ('Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 12)
+
+def rss(title, link, items):
+    '''An RSS 2.0 document with items as (guid, link, title, date) newest first.'''
+    _items = ''.join(
+        '<item><title>%s</title><link>%s</link><guid>%s</guid>'
+        '<pubDate>%s</pubDate><description>%s</description></item>'
+        % (_title, _link, _guid, format_datetime(_date), _title)
+        for _guid, _link, _title, _date in items)
+    return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+            '<title>%s</title><link>%s</link><description>%s</description>%s'
+            '</channel></rss>' % (title, link, title, _items))
+
+def atom(title, link, items):
+    '''An Atom document with items as (guid, link, title, date) newest first.'''
+    _items = ''.join(
+        '<entry><title>%s</title><link href="%s"/><id>%s</id>'
+        '<updated>%s</updated><summary>%s</summary></entry>'
+        % (_title, _link, _guid, _date.isoformat()+'Z', _title)
+        for _guid, _link, _title, _date in items)
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom"><title>%s</title>'
+            '<link href="%s"/><id>%s</id><updated>%s</updated>%s</feed>'
+            % (title, link, link, datetime.datetime.utcnow().isoformat()+'Z', _items))
+
+def post(title, paragraphs=20):
+    '''A public substack post.'''
+    return ('<!DOCTYPE html><html><head><title>%s</title>'
+            '<meta charset="utf-8"></head><body><div class="post">'
+            '<h1 class="post-title">%s</h1><div class="available-content">'
+            '<div class="body markup">%s'
+            '<img style="max-width: 1456px" src="/img.png"></div></div>'
+            '</div></body></html>' % (title, title, PARAGRAPH * paragraphs))
+
+class FixtureServer(http.server.ThreadingHTTPServer):
+    '''Serve recorded pages from memory on a loopback port, with ETags
+       so that conditional GETs get a 304. Any path below /post/ is a
+       live link.'''
+
+    daemon_threads = True
+
+    def __init__(self):
+        self.pages = {}
+        self.requests = 0
+        super().__init__(('127.0.0.1', 0), FixtureHandler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def host(self):
+        '''host:port of the server.'''
+        return '127.0.0.1:%s' % self.server_address[1]
+
+    def add(self, path, body, content_type='text/html'):
+        '''Serve body at path.'''
+        body = body.encode('utf-8')
+        self.pages[path] = (content_type, body, '"%s"' % hashlib.md5(body).hexdigest())
+
+    def page(self, path):
+        '''Return (content type, body, etag) for path or None.'''
+        if path in self.pages:
+            return self.pages[path]
+        if path.startswith('/post/') or path.endswith('/robots.txt'):
+            return ('text/html', b'<html><body>ok</body></html>', None)
+        return None
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    '''GET and HEAD for FixtureServer.'''
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes
+    disable_nagle_algorithm = True
+
+    def do_HEAD(self): #pylint: disable=invalid-name
+        '''Headers only.'''
+        self.__respond(False)
+
+    def do_GET(self): #pylint: disable=invalid-name
+        '''Headers and body.'''
+        self.__respond(True)
+
+    def __respond(self, body):
+        self.server.requests += 1
+        _page = self.server.page(urllib.parse.urlparse(self.path).path)
+        if _page is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        _type, _body, _etag = _page
+        if _etag is not None and self.headers.get('If-None-Match') == _etag:
+            self.send_response(304)
+            self.send_header('ETag', _etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', _type)
+        self.send_header('Content-Length', str(len(_body)))
+        if _etag is not None:
+            self.send_header('ETag', _etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(_body)
+
+    def log_message(self, *args): #pylint: disable=arguments-differ
+        pass
+
+class StubPocket():
+    '''The bits of pocket.Pocket that DoPocket uses, with a fixed
+       latency per API call.'''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.added = []
+        self._bulk_query = []
+
+    def add(self, url, title=None):
+        '''Add a single link.'''
+        self.calls += 1
+        time.sleep(self.latency)
+        self.added.append(url)
+        return {'status': 1, 'item': {'given_url': url, 'title': title}}, {}
+
+    def bulk_add(self, item_id, url=None, title=None, **kwargs): #pylint: disable=unused-argument
+        '''Queue an add action.'''
+        self._bulk_query.append({'action': 'add', 'url': url, 'title': title})
+        return self
+
+    def commit(self):
+        '''Send the queued actions.'''
+        self.calls += 1
+        time.sleep(self.latency)
+        _query, self._bulk_query = self._bulk_query, []
+        self.added += [_action['url'] for _action in _query]
+        return {'status': 1, 'action_results': [{'given_url': _action['url']}
+            for _action in _query]}, {}
+
+class StubDropbox():
+    '''An in-memory Dropbox with the files_* calls DoDropbox makes,
+       returning real dropbox.files types, with a fixed latency per call.'''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.bytes = 0
+        self.files = {}
+        self.sessions = {}
+        self.jobs = {}
+
+    def __call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def store(self, path, data, server_modified=None):
+        '''Put a file in the stub and return its metadata.'''
+        _blocks = b''.join(hashlib.sha256(data[_i:_i+4*1024*1024]).digest()
+            for _i in range(0, len(data), 4*1024*1024))
+        _meta = dropbox.files.FileMetadata(
+            name=path.split('/')[-1], id='id:%s' % hashlib.md5(path.encode()).hexdigest(),
+            client_modified=server_modified or datetime.datetime.utcnow().replace(microsecond=0),
+            server_modified=server_modified or datetime.datetime.utcnow().replace(microsecond=0),
+            rev='0123456789abcdef', size=len(data),
+            path_lower=path.lower(), path_display=path,
+            content_hash=hashlib.sha256(_blocks).hexdigest())
+        self.files[path.lower()] = _meta
+        return _meta
+
+    def files_upload(self, f, path, mode=None, client_modified=None, mute=False): #pylint: disable=unused-argument
+        '''Upload a small file.'''
+        self.__call()
+        self.bytes += len(f)
+        return self.store(path, f)
+
+    def files_upload_session_start(self, f):
+        '''Start an upload session.'''
+        self.__call()
+        self.bytes += len(f)
+        _id = str(len(self.sessions))
+        self.sessions[_id] = bytearray(f)
+        return dropbox.files.UploadSessionStartResult(session_id=_id)
+
+    def files_upload_session_append_v2(self, f, cursor):
+        '''Append to an upload session.'''
+        self.__call()
+        self.bytes += len(f)
+        self.sessions[cursor.session_id] += f
+
+    def files_upload_session_finish(self, f, cursor, commit):
+        '''Commit an upload session.'''
+        self.__call()
+        self.bytes += len(f)
+        return self.store(commit.path, bytes(self.sessions.pop(cursor.session_id) + f))
+
+    def files_list_folder(self, path):
+        '''List everything below path in one page.'''
+        self.__call()
+        return dropbox.files.ListFolderResult(
+            entries=[_meta for _key, _meta in self.files.items()
+                if _key.startswith(path.lower()+'/')],
+            cursor='0', has_more=False)
+
+    def files_delete_batch(self, entries):
+        '''Start a batch delete job.'''
+        self.__call()
+        _results = []
+        for _arg in entries:
+            _meta = self.files.pop(_arg.path.lower(), None)
+            if _meta is None:
+                _results.append(dropbox.files.DeleteBatchResultEntry.failure(
+                    dropbox.files.DeleteError.path_lookup(
+                        dropbox.files.LookupError.not_found)))
+            else:
+                _results.append(dropbox.files.DeleteBatchResultEntry.success(
+                    dropbox.files.DeleteBatchResultData(metadata=_meta)))
+        _job = str(len(self.jobs))
+        self.jobs[_job] = dropbox.files.DeleteBatchResult(entries=_results)
+        return dropbox.files.DeleteBatchLaunch.async_job_id(_job)
+
+    def files_delete_batch_check(self, async_job_id):
+        '''The batch delete jobs of the stub finish at once.'''
+        self.__call()
+        return dropbox.files.DeleteBatchJobStatus.complete(self.jobs.pop(async_job_id))
+
+class FakeElement():
+    '''A web element holding a part of the page.'''
+
+    def __init__(self, html, text):
+        self.html = html
+        self.text = text
+
+    def get_attribute(self, name):
+        '''Only innerHTML is supported.'''
+        return self.html if name == 'innerHTML' else None
+
+class FakeDriver():
+    '''A webdriver that "loads" pages from a FixtureServer with a fixed
+       latency per page and finds elements with ArticleParser.'''
+
+    def __init__(self, server, latency=0.0):
+        self.server = server
+        self.latency = latency
+        self.pages = 0
+        self.title = ''
+        self.page_source = ''
+        self.cookies = []
+        self.__article = ArticleParser('')
+
+    def get(self, url):
+        '''Load a page.'''
+        time.sleep(self.latency)
+        self.pages += 1
+        _page = self.server.page(urllib.parse.urlparse(url).path)
+        self.page_source = _page[1].decode('utf-8') if _page else ''
+        self.__article = ArticleParser(self.page_source)
+        self.title = self.__article.text('title')
+
+    def execute_script(self, script):
+        '''Pages are always ready.'''
+        if 'readyState' in script:
+            return 'complete'
+        return 1
+
+    def implicitly_wait(self, timeout):
+        '''Not needed.'''
+
+    def find_elements(self, by, value):
+        '''Find the article parts ArticleParser knows about.'''
+        if by == By.CLASS_NAME and value in self.__article.found:
+            return [FakeElement(self.__article.found[value], self.__article.text(value))]
+        return []
+
+    def __find(self, name):
+        if name not in self.__article.found:
+            raise NoSuchElementException(name)
+        return FakeElement(self.__article.found[name], self.__article.text(name))
+
+    def find_element_by_xpath(self, xpath):
+        '''Only //head is supported.'''
+        return self.__find(xpath.strip('/'))
+
+    def find_element_by_tag_name(self, name):
+        '''Only h1 and head are supported.'''
+        return self.__find(name)
+
+    def get_cookies(self):
+        '''Cookies "set" by the pages.'''
+        return list(self.cookies)
+
+    def add_cookie(self, cookie):
+        '''Set a cookie.'''
+        self.cookies.append(cookie)
+
+    def delete_all_cookies(self):
+        '''Clear the cookies.'''
+        self.cookies = []
+
+    def get_screenshot_as_png(self):
+        '''No screenshots offline.'''
+        return b''
+
+    def quit(self):
+        '''Nothing to stop.'''
+
+class FakeDriverPool():
+    '''Stands in for DriverPool with one FakeDriver per slot.'''
+
+    def __init__(self, server, latency=0.0):
+        self.server = server
+        self.latency = latency
+        self.drivers = {}
+
+    def get(self, slot=0):
+        '''Return the driver of slot.'''
+        if slot not in self.drivers:
+            self.drivers[slot] = FakeDriver(self.server, self.latency)
+        return self.drivers[slot]
+
+    def loaded(self, slot=0):
+        '''Pages are counted by the drivers.'''
+
+    def stopall(self):
+        '''Drop all drivers.'''
+        self.drivers = {}
+
+    def cleanup(self):
+        '''There are no browsers to quit, so never kill firefox.'''
+        return False
+
+    def save(self):
+        '''Nothing to save.'''
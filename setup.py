@@ -30,7 +30,8 @@ setuptools.setup(name='feedstokobo',
           'pocket>=0.3.6',
           'python-pushover>=0.4',
           'feedparser>=6.0.2',
-          'pdfkit>=0.6.1'
+          'pdfkit>=0.6.1',
+          'requests>=2.22.0'
       ],
       include_package_data=True,
       scripts = [
@@ -2,9 +2,9 @@
 
 __all__ = ['main']
 
-from  .main import pocketloop, substackloop
-
 def main():
-    '''Call pocketloop and substackloop from kobo'''
-    pocketloop()
-    substackloop()
+    '''Run the command given on the command line'''
+    # Importing main parses the command line and sets up the run,
+    # so keep it out of the import of the package.
+    from .main import run #pylint: disable=import-outside-toplevel
+    run()
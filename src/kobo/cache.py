@@ -7,68 +7,250 @@ The PDFs are formatted to read on a Kobo e-reader.
 
 import os
 import time
+import base64
 import datetime
 import logging
 import operator
 import functools
 import json
+import copy
+import hashlib
+import threading
 # import configparser
-from .constants import STRFTIME #pylint: disable=E0401
+from .constants import STRFTIME, HASH #pylint: disable=E0401
+from .instrument import metrics
+
+def synchronized(method):
+    '''Serialize calls to a cache method across threads.'''
+    @functools.wraps(method)
+    def _locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return _locked
 
 class Cache():
     '''A class for caching a dictionary object to a json file'''
     cache_template = {
         'links':{},
         'substack_jail':[False, datetime.datetime.now().strftime(STRFTIME)],
-        'cookies': {}
+        'cookies': {},
+        'feeds': {},
+        'dropbox': {'listed': '', 'files': {}},
+        'linkcheck': {},
+        'schedule': {},
+        'throttle': {}
         }
+    # Lists below these top-level keys get an in-memory set index
+    indexed_keys = ('links',)
+    # Lists below these keys are not sets and are never deduped
+    dedupe_skip = ('substack_jail',)
+    # Compact the journal into the snapshot after this many operations
+    journal_max = 500
 
     def __init__(self, opts):
         self.logger = logging.getLogger(__name__)
         self.opts = opts
+        self.lock = threading.RLock()
+        self.compactlinks = self.opts.compactlinks
         self.cache_fn = os.path.join(self.opts.cachedir, __name__+'.json')
-        self.cache = self.cache_template
+        self.journal_fn = os.path.join(self.opts.cachedir, __name__+'.journal')
+        self.cache = copy.deepcopy(self.cache_template)
+        self.index = {}
+        self.generation = 0
+        self.journaled = 0
+        self.needs_compact = False
+        self.__journal = None
         self.loadcache()
 
     def loadcache(self):
         ''' Load the cache from disk'''
         if self.opts.dryrun:
             self.logger.info("Loading cache in dry-run mode.")
+        _hashed = False
         if os.path.exists(self.cache_fn):
             self.logger.debug("Loading %s from disk.", self.cache_fn)
-            self.cache = json.load(open(self.cache_fn,'rt'))
+            self.cache = json.load(open(self.cache_fn,'rt'), object_hook=jsonhook)
+            self.generation = self.cache.pop('__journal__', 0)
+            _hashed = self.cache.pop('__links__', None) == HASH
+            if _hashed:
+                if not self.compactlinks:
+                    self.logger.info("Links in %s are stored as digests.", self.cache_fn)
+                self.compactlinks = True
             for _key in Cache.cache_template:
                 if _key not in self.cache:
                     self.logger.debug("Adding missing key %s to cache." , _key)
-                    self.cache[_key] = Cache.cache_template[_key]
+                    self.cache[_key] = copy.deepcopy(Cache.cache_template[_key])
         else:
             self.logger.warning('%s does not exist, not loading cache template', self.cache_fn)
-            self.cache = Cache.cache_template
+            self.cache = copy.deepcopy(Cache.cache_template)
+        self.replayjournal()
+        # Replaying with compactlinks packs the links already, but only a
+        # snapshot marked as hashed keeps them compact on the next load
+        if self.compactlinks and not (_hashed and all(isinstance(_links, LinkDigests)
+                for _links in self.cache['links'].values())):
+            self.logger.warning("Storing the links in %s as digests.", self.cache_fn)
+            self.cache['links'] = packlinks(self.cache['links'])
+            self.needs_compact = True
+        self.buildindex()
         return self.cache
 
+    def replayjournal(self):
+        '''Apply the operations in the journal written since the last snapshot.'''
+        self.journaled = 0
+        if not os.path.exists(self.journal_fn):
+            return
+        with open(self.journal_fn, 'rt') as _fh:
+            try:
+                _header = json.loads(_fh.readline())
+            except ValueError:
+                _header = {}
+            if _header.get('gen') != self.generation:
+                self.logger.debug("Journal is older than the snapshot, not replaying it.")
+                self.needs_compact = True
+                return
+            for _line in _fh:
+                try:
+                    _op = json.loads(_line, object_hook=jsonhook)
+                except ValueError:
+                    self.logger.warning("Ignoring truncated entry in %s.", self.journal_fn)
+                    self.needs_compact = True
+                    break
+                try:
+                    if _op['op'] == 'set':
+                        self.__set(_op['val'], *_op['key'])
+                    elif _op['op'] == 'append':
+                        self.__append(_op['val'], *_op['key'])
+                except (KeyError, AttributeError) as msg:
+                    self.logger.warning("Could not replay %s on %s: %s",
+                        _op['op'], _op['key'], str(msg))
+                self.journaled += 1
+        self.logger.debug("Replayed %s operations from %s.", self.journaled, self.journal_fn)
+
+    def __log(self, _op, cache_var, cache_key):
+        '''Append an operation to the journal.'''
+        if self.opts.dryrun:
+            return
+        if self.needs_compact:
+            # After a reset, dedupe or stale journal the journal no longer
+            # leads to the cache in memory, so write a snapshot (which holds
+            # this operation already) instead of losing writes until save()
+            self.compact()
+            return
+        if self.__journal is None:
+            if not os.path.exists(self.journal_fn):
+                self.__resetjournal()
+            self.__journal = open(self.journal_fn, 'at')
+        self.__journal.write(json.dumps(
+            {'op': _op, 'key': list(cache_key), 'val': cache_var}, default=jsondefault)+'\n')
+        # Hand every operation to the OS so a crash of the process loses
+        # nothing; save() still fsyncs against power loss
+        self.__journal.flush()
+        self.journaled += 1
+
+    def buildindex(self, *cache_key):
+        '''(Re)build the set index for lists below cache_key,
+           or for all indexed keys if no key is given.'''
+        cache_key = tuple(cache_key)
+        for _key in list(self.index):
+            if _key[:len(cache_key)] == cache_key:
+                del self.index[_key]
+        if not cache_key:
+            for _key in self.indexed_keys:
+                if _key in self.cache:
+                    self.__index(self.cache[_key], (_key,))
+        elif cache_key[0] in self.indexed_keys and self.haskey(*cache_key):
+            self.__index(self.get(*cache_key), cache_key)
+
+    def __index(self, _val, cache_key):
+        '''Recursively add sets for the lists in _val to the index.'''
+        if isinstance(_val, dict):
+            for _key in _val:
+                self.__index(_val[_key], cache_key+(_key,))
+        elif isinstance(_val, list):
+            try:
+                self.index[cache_key] = set(_val)
+            except TypeError:
+                self.logger.debug("Not indexing unhashable values in %s", cache_key)
+
+    @metrics.timed('cache.save')
+    @synchronized
     def save(self, updated_cache=None):
-        '''Save the cache to disk'''
+        '''Save the cache to disk: sync the journal and compact
+           it into the snapshot when it gets long.'''
         if updated_cache:
             self.update(updated_cache)
         if self.opts.dryrun:
             self.logger.info("Dry run, not saving cache.")
-        else:
-            json.dump(self.cache, open(self.cache_fn, 'wt'))
-            self.logger.debug("Cache saved to %s" , self.cache_fn)
+        elif self.needs_compact or self.journaled >= self.journal_max:
+            self.compact()
+        elif self.__journal is not None:
+            self.__journal.flush()
+            os.fsync(self.__journal.fileno())
+            self.logger.debug("Journal synced to %s" , self.journal_fn)
+
+    @synchronized
+    def compact(self):
+        '''Write a new snapshot atomically and truncate the journal.'''
+        if self.opts.dryrun:
+            self.logger.info("Dry run, not saving cache.")
+            return
+        self.generation += 1
+        # Callers may hold nested values from get(), copy them all
+        _snapshot = copy.deepcopy(self.cache)
+        _snapshot['__journal__'] = self.generation
+        if self.compactlinks:
+            _snapshot['__links__'] = HASH
+        _tmp_fn = self.cache_fn+'.tmp'
+        with open(_tmp_fn, 'wt') as _fh:
+            json.dump(_snapshot, _fh, default=jsondefault)
+            _fh.flush()
+            os.fsync(_fh.fileno())
+        os.replace(_tmp_fn, self.cache_fn)
+        self.__resetjournal()
+        self.needs_compact = False
+        self.logger.debug("Cache saved to %s" , self.cache_fn)
 
+    def __resetjournal(self):
+        '''Start an empty journal for the current snapshot generation.'''
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+        _tmp_fn = self.journal_fn+'.tmp'
+        with open(_tmp_fn, 'wt') as _fh:
+            _fh.write(json.dumps({'gen': self.generation})+'\n')
+            _fh.flush()
+            os.fsync(_fh.fileno())
+        os.replace(_tmp_fn, self.journal_fn)
+        self.journaled = 0
+
+    @synchronized
     def update(self, updated_cache):
         '''Update the internal cache attribute'''
+        if self.compactlinks and 'links' in updated_cache:
+            updated_cache['links'] = packlinks(updated_cache['links'])
         self.cache = updated_cache
+        self.needs_compact = True
+        self.buildindex()
 
+    @synchronized
     def has(self, cache_var, *cache_key):
         '''Check if internal cache has a key/var'''
-        try:
-            if cache_var in self.get(*cache_key):
-                return True
-        except KeyError:
-            self.logger.debug("Didn't find %s in %s", cache_var, cache_key)
-        return False
+        _found = False
+        if cache_key in self.index:
+            try:
+                _found = cache_var in self.index[cache_key]
+            except TypeError:
+                pass
+        else:
+            try:
+                _found = cache_var in self.get(*cache_key)
+            except KeyError:
+                self.logger.debug("Didn't find %s in %s", cache_var, cache_key)
+        # A timer per call costs more than the lookup itself
+        metrics.count('cache.hit' if _found else 'cache.miss')
+        return _found
 
+    @synchronized
     def haskey(self, *cache_key):
         '''Check if internal cache has a key/var'''
         try:
@@ -78,8 +260,10 @@ class Cache():
             self.logger.debug("Didn't find key %s in internal cache", cache_key)
         return False
 
+    @synchronized
     def get(self, *cache_key):
-        '''Retreive a value from the cache'''
+        '''Retreive a value from the cache (store changes to it with set()
+           instead of changing it in place)'''
         try:
             # Equivalent to self.cache[cache_key[0]][cache_key[1]][cache_key[...]]
             return functools.reduce(operator.getitem, cache_key, self.cache)
@@ -94,109 +278,113 @@ class Cache():
         #     raise KeyError('Key not found in inernal cache.') from err
         # return _val
 
+    @synchronized
     def set(self, cache_var, *cache_key, commit=False):
         '''Set a value in the cache and save it or not'''
-        self.logger.debug("Setting new cache for key %s", cache_key)
-        _val = None
-        try:
-            for _key in reversed(cache_key):
-                if _val is None:
-                    _val = {_key : cache_var}
-                else:
-                    _val = {_key:_val}
-        except KeyError as err:
-            raise KeyError('Key not found in inernal cache.') from err
-
-        for i in range(0, len(cache_key[:-1])):
-            if cache_key[i] in self.cache:
-                _cached = {cache_key[i]:self.cache[cache_key[i]]}
-                for _key in cache_key[i+1:]:
-                    if _key not in _cached[cache_key[i]]:
-                        _cached[cache_key[i]][_key] = _val[cache_key[i]][_key]
-                _val = _cached
-                self.logger.debug("Key %s found in internal cache while setting.",
-                   cache_key[i])
-
-        # if cache_key[0] in self.cache:
-        #     _cached = {cache_key[0]:self.cache[cache_key[0]]}
-        #     for _key in cache_key[1:]:
-        #         if _key not in _cached[cache_key[0]]:
-        #             _cached[cache_key[0]][_key] = _val[cache_key[0]][_key]
-        #     _val = _cached
-        #     self.logger.debug("Key %s found in internal cache while setting %s.",
-        #        cache_key[0], cache_var)
+        self.__set(cache_var, *cache_key)
+        self.__log('set', cache_var, cache_key)
+        if commit:
+            self.save()
 
+    def __set(self, cache_var, *cache_key):
+        self.logger.debug("Setting new cache for key %s", cache_key)
+        _val = self.cache
+        for _key in cache_key[:-1]:
+            if _key not in _val:
+                _val[_key] = {}
+            elif not isinstance(_val[_key], dict):
+                raise KeyError('Cannot set a key below a non-dict value in internal cache.')
+            else:
+                self.logger.debug("Key %s found in internal cache while setting.", _key)
+            _val = _val[_key]
+        if self.compactlinks and cache_key[0] == 'links' and len(cache_key) <= 2:
+            cache_var = packlinks(cache_var) if len(cache_key) == 1 \
+                else LinkDigests(cache_var)
         self.logger.debug("Adding val of type %s to %s in cache.",
                 str(type(cache_var)), cache_key)
-        self.cache[cache_key[0]] = _val[cache_key[0]]
-        if commit:
-            self.save()
+        _val[cache_key[-1]] = cache_var
+        if cache_key[0] in self.indexed_keys:
+            self.buildindex(*cache_key)
 
+    @synchronized
     def append_unique(self, cache_var, *cache_key, commit=False):
         '''Append unique values to a list in the cache'''
-        if not self.has(cache_var, cache_key[0]):
+        if not self.has(cache_var, *cache_key):
             self.append(cache_var, *cache_key, commit = commit)
         else:
             self.logger.debug("Value %s already exists in cache.", cache_var)
 
+    @synchronized
     def append(self, cache_var, *cache_key, commit=False):
         '''Append values to a list in the cache'''
+        self.__append(cache_var, *cache_key)
+        self.__log('append', cache_var, cache_key)
+        if commit:
+            self.save()
+
+    def __append(self, cache_var, *cache_key):
         self.logger.debug("Appending {%s:%s}" , str(cache_key), str(cache_var))
         if not self.haskey(*cache_key):
             raise KeyError('Cannot append to key that is not in internal cache.')
         _val = self.get(*cache_key)
-        if isinstance(cache_var, type(_val)):
+        if isinstance(_val, LinkDigests):
+            if isinstance(cache_var, (list, LinkDigests)):
+                _val.extend(cache_var)
+            else:
+                _val.append(cache_var)
+            return
+        if not isinstance(_val, list):
+            if isinstance(cache_var, type(_val)):
+                self.logger.debug('Concatenating like cache vars')
+                self.__set(_val + cache_var, *cache_key)
+                return
+            self.logger.error('Error trying to append internal cache')
+            raise AttributeError('Cannot append to a %s in internal cache.' % type(_val))
+        # Lists are appended in place so the index stays valid
+        if isinstance(cache_var, list):
             self.logger.debug('Concatenating like cache vars')
             _val += cache_var
+            if cache_key in self.index:
+                self.index[cache_key].update(cache_var)
         else:
-            try:
-                _val.append(cache_var)
-            except AttributeError as err:
-                self.logger.error('Error trying to append internal cache')
-                raise AttributeError from err
-        self.set(_val, *cache_key, commit = commit)
+            _val.append(cache_var)
+            if cache_key in self.index:
+                self.index[cache_key].add(cache_var)
 
+    @synchronized
     def reset(self, _key):
         '''Reset a key to default.'''
         self.logger.warning('Resetting %s key in cache.', _key)
         time.sleep(5)
         if _key not in Cache.cache_template:
             raise AttributeError("Trying to reset a non-standard key from cache.")
-        self.cache[_key] = Cache.cache_template[_key]
+        self.cache[_key] = copy.deepcopy(Cache.cache_template[_key])
+        self.buildindex(_key)
+        self.needs_compact = True
         self.save()
 
-    def __dodedupe(self, _list):
-        _vals = []
-        for _val in _list:
-            if _val not in _vals:
-                _vals.append(_val)
-            else:
-                self.logger.info("Deduping %s", _val)
-        return _vals
-
+    @synchronized
     def dedupe(self):
-        '''Dedeuplicate items and clean keys in the cache'''
-        #TODO: this only dedupes dicts two-levels deep
-        _deduped = 0
-        _cache = Cache.cache_template
-        for _key in _cache:
+        '''Deduplicate the lists in the cache in one pass, keeping the
+        first occurrence of each value. Returns the number of duplicates
+        removed per key path.'''
+        _deduped = {}
+        for _key in self.cache:
+            if _key in self.dedupe_skip:
+                self.logger.debug("Not deduping %s", _key)
+                continue
             self.logger.debug("Key %s has %s items",
                     _key, len(self.cache[_key]))
-            _vals = []
-            if isinstance(self.cache[_key], list):
-                self.logger.info("Deduping %s", _key)
-                _cache[_key] = self.__dodedupe(self.cache[_key])
-            elif isinstance(self.cache[_key], dict):
-                for _sub_key in self.cache[_key]:
-                    self.logger.info("Deduping %s in %s ", _sub_key, _key)
-                    _cache[_key][_sub_key] = self.__dodedupe(self.cache[_key][_sub_key])
-            else:
-                self.logger.debug("Not deduping non-list key %s", _key)
-                _cache[_key] = self.cache[_key]
-
-        self.cache = _cache
-        self.logger.info("Deduped %s items", _deduped)
+            _deduped.update(dedupe_nested(self.cache[_key], (_key,)))
+        for _path, _count in _deduped.items():
+            self.logger.info("Removed %s duplicates from %s", _count, _path)
+        if _deduped:
+            self.needs_compact = True
+            self.buildindex()
+        self.logger.info("Deduped %s items", sum(_deduped.values()))
+        return _deduped
 
+    @synchronized
     def cleankey(self, keys_to_compare, *cache_key):
         '''Compare the stored stored to a list of keys and remove
         cached keys that are not in the list'''
@@ -209,3 +397,96 @@ class Cache():
             if _key in cached:
                 cleaned[_key] = cached[_key]
         self.set(cleaned, *cache_key, commit=True)
+
+
+def dedupe_nested(_val, path=()):
+    '''Remove duplicates in place from every list nested in _val (dicts
+    of any depth), keeping order. Unhashable items are compared by their
+    json representation. Returns {key path: duplicates removed}.'''
+    _counts = {}
+    if isinstance(_val, dict):
+        for _key in _val:
+            _counts.update(dedupe_nested(_val[_key], path+(_key,)))
+    elif isinstance(_val, list):
+        _seen = set()
+        _vals = []
+        for _item in _val:
+            try:
+                hash(_item)
+                _marker = _item
+            except TypeError:
+                _marker = json.dumps(_item, sort_keys=True)
+            if _marker in _seen:
+                continue
+            _seen.add(_marker)
+            _vals.append(_item)
+        if len(_vals) != len(_val):
+            _counts['/'.join(str(_key) for _key in path)] = len(_val) - len(_vals)
+            _val[:] = _vals
+    return _counts
+
+
+class LinkDigests():
+    '''The links of one feed kept only as the fixed-width HASH digests
+       of the urls, which is all that has() needs, and packed into one
+       base64 string in the json snapshot.'''
+
+    def __init__(self, links=(), packed=''):
+        _packed = base64.b64decode(packed)
+        _size = hashlib.new(HASH).digest_size
+        self.digests = {_packed[_i:_i+_size] for _i in range(0, len(_packed), _size)}
+        self.extend(links)
+
+    @staticmethod
+    def digest(link):
+        '''The digest of a link, i.e., util.hashstring(link) as bytes.'''
+        return hashlib.new(HASH, link.encode('utf-8')).digest()
+
+    def __contains__(self, link):
+        if not isinstance(link, str):
+            return False
+        return self.digest(link) in self.digests
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __iter__(self):
+        '''The links are gone, so iterate over their hex digests.'''
+        return (_digest.hex() for _digest in self.digests)
+
+    def __iadd__(self, links):
+        self.extend(links)
+        return self
+
+    def append(self, link):
+        '''Add a link.'''
+        self.digests.add(self.digest(link))
+
+    def extend(self, links):
+        '''Add links, or the digests of another LinkDigests.'''
+        if isinstance(links, LinkDigests):
+            self.digests |= links.digests
+        else:
+            self.digests.update(self.digest(_link) for _link in links)
+
+    def tojson(self):
+        '''The json representation, see jsonhook.'''
+        return {'__digests__': base64.b64encode(
+            b''.join(sorted(self.digests))).decode('ascii')}
+
+def packlinks(_links):
+    '''Turn the lists of links in a dict of feeds into LinkDigests.'''
+    return {_feed: _urls if isinstance(_urls, LinkDigests) else LinkDigests(_urls)
+            for _feed, _urls in _links.items()}
+
+def jsondefault(_val):
+    '''Serialize LinkDigests for json.dump.'''
+    if isinstance(_val, LinkDigests):
+        return _val.tojson()
+    raise TypeError('%s is not JSON serializable' % type(_val))
+
+def jsonhook(_val):
+    '''Turn packed digests back into LinkDigests for json.load.'''
+    if len(_val) == 1 and '__digests__' in _val:
+        return LinkDigests(packed=_val['__digests__'])
+    return _val
@@ -7,20 +7,22 @@ The PDFs are formatted to read on a Kobo e-reader.
 
 import sys
 import os
-import time
 import datetime
 import logging
 import re
 from .constants import STRFTIME
 from .util import parseloginurls, sendpushover, hashstring
+from .driverpool import DriverPool
+from .httpfetch import HttpFetcher
+from .throttle import Throttle
+from .feeds import newentries
+from .waits import wait_ready, wait_for_element, wait_title, wait_for_exit, PhaseTimer
 try:
     import feedparser
-    from selenium import webdriver
-    from selenium.webdriver.firefox.options import Options
+    from selenium.webdriver.common.by import By
     from selenium.common.exceptions import NoSuchElementException
     from selenium.common.exceptions import InvalidCookieDomainException
     from selenium.common.exceptions import WebDriverException
-    from selenium.webdriver.common.proxy import Proxy, ProxyType
 except ImportError as msg:
     print("Error loading pacakge %s" , str(msg))
     sys.exit()
@@ -31,71 +33,84 @@ class DoSubstack():
 
     img_width_re = re.compile('max-width: (\d+)px') #pylint: disable=w1401
 
-    def __init__(self, opts, config, cache):
+    def __init__(self, opts, config, cache, driverpool=None, slot=0, customlogins=True,
+                 throttle=None):
         self.logger = logging.getLogger(__name__)
         self.logins = {}
         self.cache = cache
         self.opts = opts
         self.useropts = config['USEROPTS']
+        self.driverpool = driverpool or DriverPool(opts, self.useropts)
+        self.slot = slot
         self.driver = None
-        self.ss_status = {'pause': 0,
-                          'fetch error': False,
+        self.timer = PhaseTimer()
+        # Domains whose cached cookies are in the current driver session
+        self.cookied = set()
+        self.loaded = None
+        self.title = None
+        self.throttle = throttle or Throttle(cache, opts.throttlewait)
+        self.httpfetch = HttpFetcher(cache, self.useropts, opts.pagetimeout, self.throttle)
+        self.ss_status = {'fetch error': False,
                           'logged in': False}
         if self.opts.loginurls:
-            self.addlogins()
+            self.addlogins(customlogins)
 
     def parse_ss_entry(self, ss_entry):
         '''Parse a substack entry from SUBSTACKS'''
+        return list(self.iter_ss_entry(ss_entry))
+
+    def iter_ss_entry(self, ss_entry):
+        '''Parse a substack entry and yield (link, pdf_uri, title)
+           as each post is fetched.'''
         self.ss_status['logged in'] = bool(ss_entry['domain'] in self.logins)
         self.ss_status['fetch error'] = False
-        rss_feed = feedparser.parse('https://%s/feed' % ss_entry['domain'])
-        _pdfs  = []
+        with self.timer('feed'):
+            rss_feed = feedparser.parse('https://%s/feed' % ss_entry['domain'])
 
         if rss_feed['bozo'] == 1:
             self.logger.error(rss_feed['bozo_exception'])
         else:
-            if self.driver is None:
-                self.__setup_driver()
-            for rss_item in rss_feed['entries']:
+            for rss_item in newentries(rss_feed['entries'],
+                    lambda _item: self.cache.has(self.__pdf_uri(ss_entry, _item['link']),
+                        'links', hashstring(ss_entry['domain'])),
+                    self.opts.lookback):
+                self.title = None
                 _pdf_uri = self.__parse_rss_item(ss_entry, rss_item)
-                if self.driver is not None:
-                    _title = self.driver.title
-                else:
-                    _title = None
-                _pdfs.append( (rss_item['link'], _pdf_uri, _title) )
-        return _pdfs
-
-    def addlogins(self):
+                yield (rss_item['link'], _pdf_uri, self.title)
+
+    def addlogins(self, customlogins=True):
         '''Add custom login urls, e.g., to bypass CAPTCHA'''
         for _url in self.opts.loginurls:
             _domain = _url.split(';')[0]
             self.logins[_domain] = _url.split(';')[1]
             self.logger.info("Adding custom login for %s" , _domain)
-        self.checkforjail(release=True)
-        self.__docustomlogins()
+        if customlogins:
+            self.checkforjail(release=True)
+            self.__docustomlogins()
 
     def cleanup(self):
         '''Call this when all feeds are parsed.'''
         self.logger.debug("Cleaning up web driver.")
-        if self.driver is not None:
-            self.driver.quit()
-            time.sleep(3)
-            if os.system('pgrep firefox > /dev/null') == 0:
+        # Other slots share the pool, so clean it up even if this slot
+        # never started a driver of its own
+        if self.driverpool.cleanup():
+            if self.driver is not None:
+                self.driver = None
+            if not wait_for_exit('pgrep firefox > /dev/null', 3):
                 self.logger.warning("Manually killing firefox.")
                 os.system('killall firefox')
+        self.httpfetch.close()
+        self.timer.log(self.logger)
 
     def __docustomlogins(self):
         '''Use custom login urls to set cookies.'''
-        if self.driver is None:
-            self.__setup_driver()
-        cookies = self.cache.get('cookies')
+        self.__setup_driver()
         for domain in self.logins:
             self.driver.delete_all_cookies()
-            self.driver.get(self.logins[domain])
+            self.__load(self.logins[domain])
             self.logger.info('Logging in to %s with a custom url.' ,
                 domain)
-            cookies[domain] = self.driver.get_cookies()
-        self.cache.set(cookies, 'cookies')
+            self.cache.set(self.driver.get_cookies(), 'cookies', domain)
 
     def checkforjail(self, release=False):
         '''If not logged in check jail status and relesae if it's been a day'''
@@ -104,43 +119,59 @@ class DoSubstack():
 
         self.logger.debug("Checking jail status")
         _today = datetime.datetime.now()
-        ss_jail = self.cache.get('substack_jail')
-        self.logger.debug("Got substack_jail from cache: %s" , str(ss_jail))
-        if not ss_jail:
-            ss_jail = [False, _today.strftime(STRFTIME)]
-        if ss_jail[0]:
-            _time_diff = _today - datetime.datetime.strptime(
-                ss_jail[1], STRFTIME)
-            if _time_diff.days > 0 or release:
-                self.logger.info("Releasing from substack jail : )")
-                ss_jail[0] = False
-                sendpushover("Out of substack jail.",
-                        self.useropts['PUSHOVERDEVICE'])
-        self.cache.set(ss_jail, 'substack_jail')
+        # The jail is shared by all substack workers
+        with self.cache.lock:
+            ss_jail = self.cache.get('substack_jail')
+            self.logger.debug("Got substack_jail from cache: %s" , str(ss_jail))
+            if not ss_jail:
+                ss_jail = [False, _today.strftime(STRFTIME)]
+            if ss_jail[0]:
+                _time_diff = _today - datetime.datetime.strptime(
+                    ss_jail[1], STRFTIME)
+                if _time_diff.days > 0 or release:
+                    self.logger.info("Releasing from substack jail : )")
+                    ss_jail[0] = False
+                    sendpushover("Out of substack jail.",
+                            self.useropts['PUSHOVERDEVICE'])
+            self.cache.set(ss_jail, 'substack_jail')
         return ss_jail[0]
 
     def __setup_driver(self):
-        ''' Set up the webdriver with a proxy'''
-        web_opts = Options()
-        web_opts.headless = True
-        web_prox = Proxy()
-        web_prox.proxy_type = ProxyType.MANUAL
-        web_prox.http_proxy = self.useropts['HTTPPROXY']
-        web_prox.ssl_proxy = self.useropts['HTTPPROXY']
-        web_capabilities = webdriver.DesiredCapabilities.FIREFOX
-        web_prox.add_to_capabilities(web_capabilities)
-        self.driver = webdriver.Firefox(options=web_opts,
-            desired_capabilities=web_capabilities)
-        self.driver.implicitly_wait(10) # seconds
+        ''' Get a (warm) webdriver with a proxy from the pool'''
+        driver = self.driverpool.get(self.slot)
+        if driver is not self.driver:
+            self.cookied = set()
+            self.loaded = None
+        self.driver = driver
+
+    def __load(self, url):
+        '''Load a url in the webdriver and count it against the pool.'''
+        self.loaded = None
+        self.driver.get(url)
+        self.loaded = url
+        self.driverpool.loaded(self.slot)
+        if not wait_ready(self.driver, self.opts.pagetimeout):
+            self.logger.warning("%s did not finish loading in %s s.",
+                url, self.opts.pagetimeout)
+
+    @staticmethod
+    def __html_fn(ss_entry, link):
+        '''Name of the html file of a substack post.'''
+        _cleandomain = parseloginurls([ss_entry])[0][1]
+        return _cleandomain+'-'+link.split('/')[-1]+'.html'
+
+    def __pdf_uri(self, ss_entry, link):
+        '''Uri of the html of a substack post, which is also its key in links.'''
+        html_fn = self.__html_fn(ss_entry, link)
+        # return self.useropts['BASEURL']+'/'+ss_entry['subdir']+'/'+html_fn
+        return self.useropts['HTMLROOT']+'/'+ss_entry['subdir']+'/'+html_fn
 
     def __parse_rss_item(self, ss_entry, rss_item):
         '''Parse and individual rss item from a ss feed item'''
 
-        _cleandomain = parseloginurls([ss_entry])[0][1]
         url_basename = rss_item['link'].split('/')[-1]
-        html_fn = _cleandomain+'-'+url_basename+'.html'
-        # pdf_uri = self.useropts['BASEURL']+'/'+ss_entry['subdir']+'/'+html_fn
-        pdf_uri = self.useropts['HTMLROOT']+'/'+ss_entry['subdir']+'/'+html_fn
+        html_fn = self.__html_fn(ss_entry, rss_item['link'])
+        pdf_uri = self.__pdf_uri(ss_entry, rss_item['link'])
 
         if self.cache.has(pdf_uri, 'links', hashstring(ss_entry['domain'])):
             return None
@@ -159,12 +190,24 @@ class DoSubstack():
             self.cache.append_unique(pdf_uri, 'links', hashstring(ss_entry['domain']))
             return None
 
+        _fetched = not self.ss_status['fetch error']
         if not self.opts.cacheonly:
-            self.logger.debug("Logging in to  %s", rss_item['link'])
-            self.__driver_do_login(ss_entry, rss_item)
-            self.logger.debug("Fetching in to  %s", rss_item['link'])
-            self.__driver_fetch_item(ss_entry, rss_item['link'], html_fn, pdf_uri)
-        if not self.ss_status['fetch error']:
+            if not self.throttle.wait(ss_entry['domain']):
+                self.logger.warning("Not fetching %s while %s is backed off.",
+                    rss_item['link'], ss_entry['domain'])
+                return None
+            with self.timer('http'):
+                _fetched = self.__http_fetch_item(ss_entry, rss_item['link'], html_fn, pdf_uri)
+            if not _fetched:
+                self.__setup_driver()
+                self.logger.debug("Logging in to  %s", rss_item['link'])
+                self.__driver_do_login(ss_entry, rss_item)
+                self.logger.debug("Fetching in to  %s", rss_item['link'])
+                with self.timer('fetch'):
+                    self.__driver_fetch_item(ss_entry, rss_item['link'], html_fn, pdf_uri)
+                self.title = self.driver.title
+                _fetched = not self.ss_status['fetch error']
+        if _fetched:
             self.logger.info("Adding %s to cache" , pdf_uri)
             self.cache.append_unique(pdf_uri, 'links', hashstring(ss_entry['domain']))
         else:
@@ -178,42 +221,52 @@ class DoSubstack():
 
         if not self.cache.has(ss_entry['domain'], 'cookies'):
             self.logger.debug("Adding new cookies domain for %s" , ss_entry['domain'])
-            _cookies = self.cache.get('cookies')
-            _cookies[ss_entry['domain']] = []
-            self.cache.set(_cookies, 'cookies')
+            self.cache.set([], 'cookies', ss_entry['domain'])
 
         paywalled = False
 
         try:
-            self.driver.delete_all_cookies()
-            self.driver.get('https://%s' % ss_entry['domain'])
-            time.sleep(3)
-            _cookies = self.cache.get('cookies')
-            for cookie in _cookies[ss_entry['domain']]:
-                try:
-                    self.driver.add_cookie(cookie)
-                    self.logger.debug("Added cookie for %s." , cookie['domain'])
-                except InvalidCookieDomainException:
-                    self.logger.warning(
-                        "Tried to set cookie from %s for domain %s.",
-                            cookie['domain'], ss_entry['domain'])
-            self.driver.get(rss_item['link'])
-            time.sleep(3)
-            paywalled = bool('this post is for paying subscribers'
-                in self.driver.find_element_by_class_name('paywall').text.lower())
-        except NoSuchElementException:
-            self.logger.warning("Didn't find a paywall class? (%s)" , ss_entry['domain'])
+            self.__restore_cookies(ss_entry['domain'])
+            self.__load(rss_item['link'])
+            # Wait for either the paywall or the article to render
+            wait_for_element(self.driver, self.opts.pagetimeout,
+                (By.CLASS_NAME, 'paywall'), (By.CLASS_NAME, 'markup'))
+            _paywall = self.driver.find_elements(By.CLASS_NAME, 'paywall')
+            if _paywall:
+                paywalled = bool('this post is for paying subscribers'
+                    in _paywall[0].text.lower())
+            else:
+                self.logger.warning("Didn't find a paywall class? (%s)" , ss_entry['domain'])
         except WebDriverException as msg:
             self.logger.error("Error fetching %s (%s)",
                 'https://%s' % ss_entry['domain'], str(msg))
             self.ss_status['fetch error'] = True
         return paywalled
 
+    def __restore_cookies(self, domain):
+        '''Inject the cached cookies for domain once per driver session.'''
+        if domain in self.cookied:
+            return
+        # Cookies can only be set for the domain of the current page,
+        # robots.txt is the cheapest page to get there.
+        self.__load('https://%s/robots.txt' % domain)
+        self.driver.delete_all_cookies()
+        for cookie in self.cache.get('cookies', domain):
+            try:
+                self.driver.add_cookie(cookie)
+                self.logger.debug("Added cookie for %s." , cookie['domain'])
+            except InvalidCookieDomainException:
+                self.logger.warning(
+                    "Tried to set cookie from %s for domain %s.",
+                        cookie['domain'], domain)
+        self.cookied.add(domain)
+
     def __driver_do_login(self, ss_entry, rss_item):
         '''Handle logging in to substack.'''
         if self.ss_status['logged in']:
             return
-        paywalled = self.__driver_check_paywall(ss_entry, rss_item)
+        with self.timer('paywall'):
+            paywalled = self.__driver_check_paywall(ss_entry, rss_item)
         if not paywalled:
             # self.ss_status['logged in'] = True
             return
@@ -226,35 +279,40 @@ class DoSubstack():
             self.ss_status['fetch error'] = True
             return
 
-        self.logger.debug("Pausing for %s seconds." , (self.ss_status['pause']*60))
-        time.sleep(self.ss_status['pause'] * 60)
-        self.ss_status['pause'] += 1
+        if not self.throttle.wait(ss_entry['domain'], login=True):
+            self.ss_status['fetch error'] = True
+            return
 
         self.logger.debug('Logging in to %s' , ss_entry['domain'])
         login_uri='https://%s/account/login?email=%s&with_password=1' \
             % (ss_entry['domain'], ss_entry['login'])
-        self.driver.get(login_uri)
-        time.sleep(3)
-        try:
-            self.driver.find_element_by_xpath(
-                '//input[@name="password"]'
-                    ).send_keys(ss_entry['password'])
-            self.driver.find_element_by_xpath(
-                '//button[@class="button primary "]'
-                    ).submit()
-        except NoSuchElementException:
-            self.logger.warning(
-                "Did not find username / password fields in %s",
-                ss_entry['domain']
-            )
-        _timeout = 30
-        while 'my account' in self.driver.title.lower():
-            time.sleep(1)
-            _timeout -= 1
-            if _timeout == 0:
+        with self.timer('login'):
+            self.__load(login_uri)
+            try:
+                _password = wait_for_element(self.driver, self.opts.pagetimeout,
+                    (By.XPATH, '//input[@name="password"]'))
+                if _password is None:
+                    raise NoSuchElementException('password')
+                _password.send_keys(ss_entry['password'])
+                self.driver.find_element_by_xpath(
+                    '//button[@class="button primary "]'
+                        ).submit()
+            except NoSuchElementException:
+                self.logger.warning(
+                    "Did not find username / password fields in %s",
+                    ss_entry['domain']
+                )
+            # The login page is titled "my account" until we are redirected
+            if not wait_title(self.driver, self.opts.logintimeout,
+                    lambda _title: 'my account' not in _title):
+                self.ss_status['fetch error'] = True
+                if 'captcha' in self.driver.page_source.lower():
+                    # The domain is pushing back, the password is fine
+                    self.throttle.pushback(ss_entry['domain'], 'CAPTCHA at login')
+                    return
                 self.logger.warning('There was an error logging in to %s.' ,
                     ss_entry['domain'])
-                self.ss_status['fetch error'] = True
+                self.throttle.pushback(ss_entry['domain'], 'login failed')
                 self.cache.set(
                         [True, datetime.datetime.now().strftime(STRFTIME)],
                         'substack_jail')
@@ -264,12 +322,11 @@ class DoSubstack():
                     self.driver.get_screenshot_as_png())
                 return
             self.ss_status['logged in']=True
-            return
-
-    def __driver_fetch_item(self, ss_entry, rss_link, html_fn, pdf_uri):
-        '''Once we are logged in and out of jail, we can fetch
-            the actual substack entry'''
+            self.throttle.success(ss_entry['domain'])
 
+    def __html_dir(self, ss_entry):
+        '''Return the directory to write html files for ss_entry to,
+           or None if it cannot be created.'''
         html_dir = os.path.join(self.useropts['HTMLROOT']
                     ,ss_entry['subdir'])
         if not os.path.exists(html_dir):
@@ -278,22 +335,67 @@ class DoSubstack():
                 os.mkdir(html_dir)
             except OSError as msg:
                 self.logger.error("Could not create %s: %s" , html_dir, str(msg))
-                self.ss_status['fetch error'] = True
-                return not self.ss_status['fetch error']
+                return None
+        return html_dir
+
+    def __write_html(self, html_path, head, title, article, rss_link, pdf_uri):
+        '''Write the simple html view of an article that is turned into a PDF.'''
+        with open(html_path, 'wt') as _fh:
+            self.logger.debug("Writing to %s", html_path)
+            _fh.write('<head>%s</head>' \
+                % head.replace(rss_link, pdf_uri))
+            _fh.write('<html><body>\n<h1>%s</h1>\n' % title)
+            _fh.write('<html><body>%s' \
+                % re.sub(DoSubstack.img_width_re,
+                         'max-width: 640px',
+                         article) )
+            _fh.write('</body></html>')
+
+    def __http_fetch_item(self, ss_entry, rss_link, html_fn, pdf_uri):
+        '''Try to fetch a public post without the browser.'''
+        if self.opts.browseronly:
+            return False
+        article = self.httpfetch.fetch(ss_entry['domain'], rss_link)
+        if article is None:
+            self.logger.debug("Falling back to the browser for %s.", rss_link)
+            return False
+        html_dir = self.__html_dir(ss_entry)
+        if html_dir is None:
+            return False
+        self.__write_html(os.path.join(html_dir, html_fn), article.found.get('head', ''),
+            article.found.get('h1', ''), article.found['markup'], rss_link, pdf_uri)
+        self.title = article.text('title')
+        self.logger.info("Fetched %s without the browser.", rss_link)
+        self.throttle.success(ss_entry['domain'])
+        return True
+
+    def __driver_fetch_item(self, ss_entry, rss_link, html_fn, pdf_uri):
+        '''Once we are logged in and out of jail, we can fetch
+            the actual substack entry'''
+
+        html_dir = self.__html_dir(ss_entry)
+        if html_dir is None:
+            self.ss_status['fetch error'] = True
+            return not self.ss_status['fetch error']
 
         if self.ss_status['fetch error']:
             self.logger.warning("Not fetching %s after previous error.", ss_entry['domain'])
             return not self.ss_status['fetch error']
 
-        self.driver.get(rss_link)
-        _cookies = self.cache.get('cookies')
-        _cookies[ss_entry['domain']] = self.driver.get_cookies()
-        self.cache.set(_cookies, 'cookies')
+        if self.loaded != rss_link:
+            self.__load(rss_link)
+        else:
+            self.logger.debug("Reusing the loaded page for %s.", rss_link)
+        _cookies = self.driver.get_cookies()
+        self.cache.set(_cookies, 'cookies', ss_entry['domain'])
         self.logger.debug('Cached %s cookies for %s.',
-            len(_cookies[ss_entry['domain']]), ss_entry['domain'])
+            len(_cookies), ss_entry['domain'])
 
+        article = wait_for_element(self.driver, self.opts.pagetimeout,
+            (By.CLASS_NAME, 'markup'))
         try:
-            article = self.driver.find_element_by_class_name('markup')
+            if article is None:
+                raise NoSuchElementException('markup')
             if not article.text:
                 self.logger.error("Empty article %s", rss_link)
                 self.ss_status['fetch error'] = True
@@ -310,17 +412,10 @@ class DoSubstack():
             self.ss_status['fetch error'] = True
             return not self.ss_status['fetch error']
 
-        with open(os.path.join(html_dir, html_fn), 'wt') as _fh:
-            self.logger.debug("Writing to %s", html_fn)
-            _fh.write('<head>%s</head>' \
-                % head.replace(rss_link, pdf_uri))
-            _fh.write('<html><body>\n<h1>%s</h1>\n' \
-                % self.driver.find_element_by_tag_name('h1').get_attribute('innerHTML'))
-            _fh.write('<html><body>%s' \
-                % re.sub(DoSubstack.img_width_re,
-                         'max-width: 640px',
-                         article.get_attribute('innerHTML')) )
-            _fh.write('</body></html>')
+        self.__write_html(os.path.join(html_dir, html_fn), head,
+            self.driver.find_element_by_tag_name('h1').get_attribute('innerHTML'),
+            article.get_attribute('innerHTML'), rss_link, pdf_uri)
+        self.throttle.success(ss_entry['domain'])
 
         self.ss_status['fetch error'] = False
         return not self.ss_status['fetch error']
@@ -0,0 +1,257 @@
+'''
+Keep headless Firefox sessions warm between runs. Each session is
+driven by a geckodriver process listening on a local port that outlives
+the python process, so the next run can reattach instead of starting
+a new browser.
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import shutil
+import logging
+import threading
+import subprocess
+
+try:
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+    from selenium.common.exceptions import WebDriverException
+    from selenium.webdriver.common.proxy import Proxy, ProxyType
+except ImportError as msg:
+    print("Error loading pacakge %s" , str(msg))
+    sys.exit()
+
+class AttachedDriver(webdriver.Remote):
+    '''A Remote webdriver that attaches to a running session
+       instead of starting a new one.'''
+
+    def __init__(self, command_executor, session_id):
+        self.__session_id = session_id
+        super().__init__(command_executor=command_executor,
+            desired_capabilities={})
+
+    def start_session(self, *args, **kwargs): #pylint: disable=unused-argument
+        '''Reuse the existing session id.'''
+        self.session_id = self.__session_id
+        self.w3c = True
+        self.capabilities = {}
+
+class DriverPool():
+    '''Hand out Firefox webdrivers by slot number, health-check them,
+       and recycle them after a number of pages or a memory limit.'''
+
+    # Pages between memory checks, reading /proc costs more than a page
+    MEMCHECK = 10
+
+    def __init__(self, opts, useropts):
+        self.logger = logging.getLogger(__name__)
+        self.useropts = useropts
+        self.keepwarm = opts.warmdriver
+        self.maxpages = opts.driverpages
+        self.maxmem = opts.drivermem
+        self.state_fn = os.path.join(opts.cachedir, __name__+'.json')
+        self.drivers = {}
+        self.slots = {}
+        self.__lock = threading.Lock()
+        if os.path.exists(self.state_fn):
+            try:
+                with open(self.state_fn, 'rt') as _fh:
+                    self.slots = {int(_k): _v for _k, _v in json.load(_fh).items()}
+            except ValueError:
+                self.logger.warning("Ignoring unreadable %s", self.state_fn)
+
+    def __capabilities(self):
+        '''Firefox capabilities with the proxy from the config.'''
+        web_prox = Proxy()
+        web_prox.proxy_type = ProxyType.MANUAL
+        web_prox.http_proxy = self.useropts['HTTPPROXY']
+        web_prox.ssl_proxy = self.useropts['HTTPPROXY']
+        web_capabilities = webdriver.DesiredCapabilities.FIREFOX.copy()
+        web_prox.add_to_capabilities(web_capabilities)
+        return web_capabilities
+
+    def get(self, slot=0):
+        '''Return a working driver for slot, reattaching to or
+           starting a Firefox session as needed.'''
+        if slot in self.drivers:
+            if not self.needsrecycle(slot):
+                return self.drivers[slot]
+            self.logger.info("Recycling web driver %s.", slot)
+            self.stop(slot)
+        elif self.keepwarm and slot in self.slots:
+            # Check the memory of a warm browser before reusing it
+            self.slots[slot].pop('memchecked', None)
+            driver = self.__attach(slot)
+            if driver is not None and not self.needsrecycle(slot):
+                self.logger.debug("Reattached to warm web driver %s.", slot)
+                self.drivers[slot] = driver
+                return driver
+            self.stop(slot)
+        self.drivers[slot] = self.__start(slot)
+        return self.drivers[slot]
+
+    def loaded(self, slot=0):
+        '''Count a page load against the driver in slot.'''
+        if slot in self.slots:
+            self.slots[slot]['pages'] += 1
+
+    def __attach(self, slot):
+        '''Attach to the session recorded for slot if it is still alive.'''
+        driver = attach(self.slots[slot])
+        if driver is None or not healthy(driver):
+            self.logger.info("Warm web driver %s is not responding.", slot)
+            return None
+        return driver
+
+    def __start(self, slot):
+        '''Start a new headless Firefox for slot.'''
+        web_opts = Options()
+        web_opts.headless = True
+        _start = time.time()
+        if self.keepwarm:
+            _port = freeport()
+            _gecko = subprocess.Popen(
+                [shutil.which('geckodriver') or 'geckodriver', '--port', str(_port)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True)
+            if not waitforport(_port):
+                _gecko.kill()
+                raise WebDriverException(
+                    "geckodriver did not listen on port %s" % _port)
+            driver = webdriver.Remote(command_executor='http://127.0.0.1:%s' % _port,
+                desired_capabilities=self.__capabilities(), options=web_opts)
+            self.slots[slot] = {'port': _port,
+                                'geckodriver': _gecko.pid,
+                                'firefox': driver.capabilities.get('moz:processID'),
+                                'session': driver.session_id,
+                                'pages': 0}
+        else:
+            driver = webdriver.Firefox(options=web_opts,
+                desired_capabilities=self.__capabilities())
+            self.slots[slot] = {'firefox': driver.capabilities.get('moz:processID'),
+                                'pages': 0}
+        # Readiness is awaited explicitly, see waits.py
+        driver.implicitly_wait(0)
+        self.logger.info("Started web driver %s in %.1f s.", slot, time.time() - _start)
+        return driver
+
+    def needsrecycle(self, slot):
+        '''Check the page count and memory use of the driver in slot.'''
+        _state = self.slots.get(slot, {})
+        _pages = _state.get('pages', 0)
+        if _pages >= self.maxpages:
+            self.logger.debug("Web driver %s loaded %s pages.", slot, _pages)
+            return True
+        if 'memchecked' in _state and _pages - _state['memchecked'] < self.MEMCHECK:
+            return False
+        _state['memchecked'] = _pages
+        _mem = memory(_state.get('firefox'))
+        if _mem > self.maxmem:
+            self.logger.debug("Web driver %s is using %s MB.", slot, _mem)
+            return True
+        return False
+
+    def stop(self, slot):
+        '''Quit the driver in slot and stop its geckodriver.'''
+        driver = self.drivers.pop(slot, None)
+        _state = self.slots.pop(slot, {})
+        if driver is None and 'session' in _state:
+            driver = attach(_state)
+        if driver is not None:
+            try:
+                driver.quit()
+            except Exception as msg: #pylint: disable=broad-except
+                self.logger.debug("Error quitting web driver %s: %s", slot, str(msg))
+        if _state.get('geckodriver'):
+            try:
+                os.kill(_state['geckodriver'], signal.SIGTERM)
+            except OSError:
+                pass
+        self.save()
+
+    def stopall(self):
+        '''Stop every driver, including warm sessions from earlier runs.'''
+        for slot in set(self.slots) | set(self.drivers):
+            self.logger.info("Stopping web driver %s.", slot)
+            self.stop(slot)
+
+    def cleanup(self):
+        '''Call at the end of a run: keep warm drivers alive, quit the rest.'''
+        if self.keepwarm:
+            self.logger.debug("Keeping %s web drivers warm.", len(self.drivers))
+            self.drivers = {}
+            self.save()
+        else:
+            self.stopall()
+        return not self.keepwarm
+
+    def save(self):
+        '''Write the state of the warm sessions to disk.'''
+        if not self.keepwarm and not os.path.exists(self.state_fn):
+            return
+        with self.__lock, open(self.state_fn, 'wt') as _fh:
+            json.dump({_slot: _state for _slot, _state in list(self.slots.items())
+                if 'session' in _state}, _fh)
+
+def attach(_state):
+    '''Attach to the session described by a slot state, or return None.'''
+    try:
+        return AttachedDriver('http://127.0.0.1:%s' % _state['port'], _state['session'])
+    except (WebDriverException, OSError, KeyError):
+        return None
+
+def healthy(driver):
+    '''Check that the browser behind driver still answers.'''
+    try:
+        return driver.execute_script('return 1;') == 1
+    except Exception: #pylint: disable=broad-except
+        # A dead geckodriver shows up as a urllib3 connection error
+        return False
+
+def freeport():
+    '''Ask the kernel for a free local port.'''
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as _sock:
+        _sock.bind(('127.0.0.1', 0))
+        return _sock.getsockname()[1]
+
+def waitforport(port, timeout=10):
+    '''Wait until something listens on a local port.'''
+    _until = time.time() + timeout
+    while time.time() < _until:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as _sock:
+            if _sock.connect_ex(('127.0.0.1', port)) == 0:
+                return True
+        time.sleep(0.1)
+    return False
+
+def memory(pid):
+    '''Resident memory in MB of pid and its direct children (Linux only).'''
+    if not pid:
+        return 0
+    _pids = [str(pid)]
+    try:
+        for _proc in os.listdir('/proc'):
+            if not _proc.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % _proc, 'rt') as _fh:
+                    if _fh.read().rsplit(')', 1)[1].split()[1] == str(pid):
+                        _pids.append(_proc)
+            except (OSError, IndexError):
+                continue
+    except OSError:
+        return 0
+    _kb = 0
+    for _pid in _pids:
+        try:
+            with open('/proc/%s/status' % _pid, 'rt') as _fh:
+                for _line in _fh:
+                    if _line.startswith('VmRSS:'):
+                        _kb += int(_line.split()[1])
+        except (OSError, ValueError):
+            continue
+    return _kb // 1024
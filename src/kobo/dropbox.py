@@ -4,14 +4,17 @@ import os
 import sys
 import time
 import datetime
-import tempfile
 import logging
+from .render import PdfRenderer, PdfCache
+from .constants import STRFTIME
+from .util import contenthash
+from .instrument import metrics
 # from .util import checkurl
 # from .server import HttpdThread
 
 try:
     import dropbox
-    import pdfkit
+    import requests
 except ImportError as msg:
     print("Error loading pacakge %s" , str(msg))
     sys.exit()
@@ -33,69 +36,190 @@ class DoDropbox():
                 'grayscale': '',
                 'quiet': ''
                 }
+    # Files larger than this are sent in chunks through an upload session
+    UPLOAD_CHUNK = 8 * 1024 * 1024
+    UPLOAD_RETRIES = 5
+    # files_delete_batch accepts at most 1000 entries
+    DELETE_BATCH = 1000
+    DELETE_TIMEOUT = 300
+    # List the remote folder to refresh the manifest this often
+    RELIST_DAYS = 7
 
-    def __init__(self, opts, config):
+    def __init__(self, opts, config, cache=None):
         self.opts = opts
         self.config = config
+        self.cache = cache
+        self.__listed = {}
         self.dbx = dropbox.Dropbox(config['USEROPTS']['DBACCESS'])
+        self.renderer = PdfRenderer(
+            PdfCache(opts.cachedir, opts.pdfcachesize) if opts.pdfcachesize else None)
         self.httpd = None
 
-    def pdftodropbox(self, pdf_uri, pdfopts, font_size):
-        '''Upload a PDF file to Dropbox'''
-        if self.opts.dryrun:
-            logger.info("But not really because dry-run.")
-            return  True
-        # if self.httpd is None:
-        #     self.httpd = HttpdThread()
-        #     self.httpd.start()
-        tmp_fn = uritopdf(pdf_uri, pdfopts, font_size)
-        if tmp_fn is not None:
+    def upload(self, pdf_uri, tmp_fn):
+        '''Upload a rendered PDF and remove the local file.'''
+        if tmp_fn is None:
+            logger.debug("Not attepting db upload after pdfkit error.")
+            return False
+        _name = pdf_uri.split('/')[-1].replace('.html','.pdf')
+        try:
+            if self.__unchanged(tmp_fn, _name):
+                logger.info("%s is already in Dropbox, not uploading.", _name)
+                metrics.count('dropbox.unchanged')
+                return True
             logger.debug("Saving pdf of %s to dropbox." , pdf_uri)
-            self.__dbupload(tmp_fn, '/',
+            res = self.__dbupload(tmp_fn, '/',
                 self.config['USEROPTS']['DBREMOTEDIR'],
-                pdf_uri.split('/')[-1].replace('.html','.pdf')
+                _name
                 )
-            os.remove(tmp_fn)
-        else:
-            logger.debug("Not attepting db upload after pdfkit error.")
-            return False
-        return True
+        finally:
+            # Also unpins a cached PDF if the upload raised
+            self.renderer.release(tmp_fn)
+        if res is not None:
+            self.__remember(res)
+        return res is not None
 
     def prunedropbox(self, days):
-        '''Prune the uploaded PDFs to files younger than days.'''
-        path = self.config['USEROPTS']['DBREMOTEDIR']
-        while '//' in path:
-            path = path.replace('//', '/')
-        result = self.dbx.files_list_folder(path)
-        _today = datetime.datetime.now()
-        to_delete = []
-        def __getpdfstodelete(cursor):
-            '''Iterate through PDF dir and collect files older
-            than a week to delete'''
-            _to_delete = []
-            for _c in cursor.entries:
-                _time_diff = _today - _c.server_modified
-                if _time_diff.days >= int(days):
-                    _to_delete.append(_c)
-            return _to_delete
+        '''Prune the uploaded PDFs to files younger than days. Stale files
+        are worked out from the local manifest of uploads; the remote folder
+        is only listed on the first prune, every RELIST_DAYS days or with
+        --relistdropbox.'''
+        path = self.__remotedir()
         logger.info("Pruning %s to %s days.",
                         path, days)
-        to_delete += __getpdfstodelete(result)
-        while result.has_more:
-            result = self.dbx.files_list_folder_continue(result)
-            to_delete += __getpdfstodelete(result)
-        for _c in to_delete:
-            if self.opts.dryrun:
-                logger.info("Not deleting %s", _c.name)
-                continue
+        if self.cache is None or self.__needslisting():
+            self.__listfolder(path)
+        _cutoff = datetime.datetime.now() - datetime.timedelta(days=int(days))
+        to_delete = [_entry for _key, _entry in self.__manifest().items()
+            if _key.startswith(path.lower()+'/') and
+            datetime.datetime.strptime(_entry['server_modified'], STRFTIME) <= _cutoff]
+        if not to_delete:
+            logger.info("Nothing to prune.")
+            return
+        if self.opts.dryrun:
+            for _entry in to_delete:
+                logger.info("Not deleting %s", _entry['name'])
+            return
+        _manifest = dict(self.__manifest())
+        for _key in self.__deletebatch(to_delete):
+            _manifest.pop(_key, None)
+        if self.cache is not None:
+            self.cache.set(_manifest, 'dropbox', 'files')
+
+    def __remotedir(self):
+        '''The remote folder without duplicate or trailing slashes.'''
+        path = '/%s' % self.config['USEROPTS']['DBREMOTEDIR']
+        while '//' in path:
+            path = path.replace('//', '/')
+        return path.rstrip('/')
+
+    def __manifest(self):
+        '''The files we know to be in Dropbox keyed by lowercase path.'''
+        if self.cache is None:
+            return self.__listed
+        return self.cache.get('dropbox', 'files')
+
+    def __needslisting(self):
+        '''Check if the manifest has to be refreshed from Dropbox.'''
+        if self.opts.relistdropbox:
+            return True
+        _listed = self.cache.get('dropbox', 'listed')
+        if not _listed:
+            return True
+        _age = datetime.datetime.now() - datetime.datetime.strptime(_listed, STRFTIME)
+        return _age.days >= DoDropbox.RELIST_DAYS
+
+    def __unchanged(self, fullname, name):
+        '''Check if the manifest has a remote file with the same bytes.'''
+        _entry = self.__manifest().get(('%s/%s' % (self.__remotedir(), name)).lower())
+        if not _entry or not _entry.get('content_hash'):
+            return False
+        return _entry['content_hash'] == contenthash(fullname)
+
+    def __remember(self, res):
+        '''Record an uploaded (or listed) file in the manifest.'''
+        _entry = {'name': res.name,
+                  'path': res.path_display,
+                  'server_modified': res.server_modified.strftime(STRFTIME),
+                  'content_hash': res.content_hash}
+        if self.cache is None:
+            self.__listed[res.path_lower] = _entry
+        else:
+            self.cache.set(_entry, 'dropbox', 'files', res.path_lower)
+
+    def __listfolder(self, path):
+        '''Page through the remote folder and replace the manifest
+        entries below path with what is actually there.'''
+        logger.info("Listing %s in Dropbox.", path)
+        _manifest = {_key: _entry for _key, _entry in self.__manifest().items()
+            if not _key.startswith(path.lower()+'/')}
+        result = self.__retry(self.dbx.files_list_folder, path)
+        while True:
+            for _c in result.entries:
+                if isinstance(_c, dropbox.files.FileMetadata):
+                    _manifest[_c.path_lower] = {'name': _c.name,
+                        'path': _c.path_display,
+                        'server_modified': _c.server_modified.strftime(STRFTIME),
+                        'content_hash': _c.content_hash}
+            if not result.has_more:
+                break
+            result = self.__retry(self.dbx.files_list_folder_continue, result.cursor)
+        if self.cache is None:
+            self.__listed = _manifest
+        else:
+            self.cache.set(_manifest, 'dropbox', 'files')
+            self.cache.set(datetime.datetime.now().strftime(STRFTIME), 'dropbox', 'listed')
+
+    def __deletebatch(self, entries):
+        '''Delete manifest entries in batches and return the lowercase
+        paths of the files that are gone from Dropbox.'''
+        deleted = []
+        for _i in range(0, len(entries), DoDropbox.DELETE_BATCH):
+            _batch = entries[_i:_i+DoDropbox.DELETE_BATCH]
             try:
-                self.dbx.files_delete(_c.path_display)
-                logger.info("Deleted %s", _c.name)
-            except dropbox.exceptions.ApiError:
-                logger.error("Error deleting %s", _c.name)
+                _launch = self.__retry(self.dbx.files_delete_batch,
+                    [dropbox.files.DeleteArg(_entry['path']) for _entry in _batch])
+                if _launch.is_async_job_id():
+                    _result = self.__pollbatch(_launch.get_async_job_id())
+                else:
+                    _result = _launch.get_complete()
+            except (dropbox.exceptions.DropboxException,
+                    requests.exceptions.RequestException) as err:
+                logger.error("Error deleting %s files: %s", len(_batch), str(err))
+                continue
+            if _result is None:
+                continue
+            for _entry, _status in zip(_batch, _result.entries):
+                if _status.is_success():
+                    logger.info("Deleted %s", _entry['name'])
+                elif _status.get_failure().is_path_lookup() and \
+                        _status.get_failure().get_path_lookup().is_not_found():
+                    logger.debug("%s was already deleted.", _entry['name'])
+                else:
+                    logger.error("Error deleting %s", _entry['name'])
+                    continue
+                deleted.append(_entry['path'].lower())
+        metrics.count('dropbox.deleted', len(deleted))
+        return deleted
+
+    def __pollbatch(self, job_id):
+        '''Wait for an asynchronous batch delete to finish.'''
+        _wait = 0.5
+        _until = time.time() + DoDropbox.DELETE_TIMEOUT
+        while time.time() < _until:
+            _status = self.__retry(self.dbx.files_delete_batch_check, job_id)
+            if _status.is_complete():
+                return _status.get_complete()
+            if _status.is_failed():
+                logger.error("Batch delete failed: %s", str(_status.get_failed()))
+                return None
+            time.sleep(_wait)
+            _wait = min(_wait * 2, 5)
+        logger.error("Gave up waiting for batch delete after %s s.", DoDropbox.DELETE_TIMEOUT)
+        return None
 
     def cleanup(self):
         '''Clean up after all PDFs are uploaded.'''
+        self.renderer.shutdown()
         if self.httpd is not None:
             self.httpd.stop()
             self.httpd.join()
@@ -111,37 +235,67 @@ class DoDropbox():
         while '//' in path:
             path = path.replace('//', '/')
         mtime = os.path.getmtime(fullname)
-        with open(fullname, 'rb') as _f:
-            data = _f.read()
+        size = os.path.getsize(fullname)
+        client_modified = datetime.datetime(*time.gmtime(mtime)[:6])
+        _start = time.time()
         try:
-            res = self.dbx.files_upload(
-                data, path, dropbox.files.WriteMode.overwrite,
-                client_modified=datetime.datetime(*time.gmtime(mtime)[:6]),
-                mute=True)
+            with open(fullname, 'rb') as _f:
+                if size <= DoDropbox.UPLOAD_CHUNK:
+                    res = self.__retry(self.dbx.files_upload,
+                        _f.read(), path, dropbox.files.WriteMode.overwrite,
+                        client_modified=client_modified, mute=True)
+                else:
+                    res = self.__sessionupload(_f, size, path, client_modified)
         except dropbox.exceptions.ApiError as err:
             logger.error('*** API error %s', str(err))
             return None
+        except (dropbox.exceptions.DropboxException, requests.exceptions.RequestException) as err:
+            logger.error('*** Giving up uploading %s: %s', name, str(err))
+            return None
+        _elapsed = max(time.time() - _start, 0.001)
+        metrics.add('dropbox.upload', _elapsed)
+        metrics.count('dropbox.bytes', size)
+        logger.info("Uploaded %s (%.1f MB) in %.1f s, %.2f MB/s.", name,
+            size/1024/1024, _elapsed, size/1024/1024/_elapsed)
         logger.debug('uploaded as %s' , str(res.name.encode('utf8')))
         return res
 
+    def __sessionupload(self, _f, size, path, client_modified):
+        '''Stream a large file in chunks through an upload session.'''
+        _session = self.__retry(self.dbx.files_upload_session_start,
+            _f.read(DoDropbox.UPLOAD_CHUNK))
+        cursor = dropbox.files.UploadSessionCursor(
+            session_id=_session.session_id, offset=_f.tell())
+        commit = dropbox.files.CommitInfo(path=path,
+            mode=dropbox.files.WriteMode.overwrite,
+            client_modified=client_modified, mute=True)
+        res = None
+        while cursor.offset < size:
+            _f.seek(cursor.offset)
+            _chunk = _f.read(DoDropbox.UPLOAD_CHUNK)
+            if cursor.offset + len(_chunk) >= size:
+                res = self.__retry(self.dbx.files_upload_session_finish,
+                    _chunk, cursor, commit)
+            else:
+                self.__retry(self.dbx.files_upload_session_append_v2, _chunk, cursor)
+            cursor.offset += len(_chunk)
+        return res
 
-def uritopdf(uri, pdfopts, fontsize=None):
-    '''Convert a url to a pdf file'''
-    if fontsize is not None:
-        pdfopts['minimum-font-size'] = fontsize
-    logger.debug(pdfopts)
-    # if not checkurl(uri):
-    #     logger.warning("Skipping %s because it does not exist.", uri)
-    #     return None
-    try:
-        logger.info("Saving %s to pdf." , uri)
-        # pdf = pdfkit.from_url(uri, False, options=pdfopts)
-        pdf = pdfkit.from_file(uri, False, options=pdfopts)
-    except OSError:
+    def __retry(self, call, *args, **kwargs):
+        '''Call a Dropbox API method, backing off on transient errors.'''
+        _backoff = 1
+        for _try in range(DoDropbox.UPLOAD_RETRIES):
+            try:
+                return call(*args, **kwargs)
+            except (dropbox.exceptions.RateLimitError,
+                    dropbox.exceptions.InternalServerError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as err:
+                if _try == DoDropbox.UPLOAD_RETRIES - 1:
+                    raise
+                _wait = getattr(err, 'backoff', None) or _backoff
+                logger.warning("Dropbox error (%s), retrying in %s s.", str(err), _wait)
+            time.sleep(_wait)
+            _backoff *= 2
         return None
-    with tempfile.NamedTemporaryFile(delete=False) as _fh:
-        _fh.write(pdf)
-        _fn = _fh.name
-    if os.path.getsize(_fn) > 5096: # Check here if a real PDF was made
-        return _fn
-    return None
+
@@ -0,0 +1,126 @@
+'''Fetch rss feeds in parallel and remember their ETag/Last-Modified headers.'''
+import sys
+import time
+import logging
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from .util import hashstring
+from .instrument import metrics
+
+try:
+    import feedparser
+except ImportError as msg:
+    print("Error loading pacakge %s" , str(msg))
+    sys.exit()
+
+class FeedFetcher():
+    '''Download rss feeds with a bounded number of threads
+       and a limit on concurrent connections per host.'''
+
+    def __init__(self, cache, threads=8, per_host=2):
+        self.logger = logging.getLogger(__name__)
+        self.cache = cache
+        self.threads = max(1, threads)
+        self.per_host = max(1, per_host)
+        self.timings = {}
+        self.__hostlocks = {}
+        self.__lock = threading.Lock()
+
+    def __hostlock(self, url):
+        '''Return the semaphore that limits connections to the host of url.'''
+        _host = urllib.parse.urlparse(url).netloc
+        with self.__lock:
+            if _host not in self.__hostlocks:
+                self.__hostlocks[_host] = threading.BoundedSemaphore(self.per_host)
+            return self.__hostlocks[_host]
+
+    def __fetch(self, url, headers):
+        '''Download and parse a single feed (runs in a worker thread).'''
+        with self.__hostlock(url):
+            _start = time.time()
+            feed = feedparser.parse(url,
+                etag=headers.get('etag'),
+                modified=headers.get('modified'))
+            _elapsed = time.time() - _start
+            metrics.add('feed.fetch', _elapsed)
+            return feed, _elapsed
+
+    def headers(self, _f):
+        '''Return the cached conditional GET headers for a feed.'''
+        if self.cache.haskey('feeds', hashstring(_f)):
+            return self.cache.get('feeds', hashstring(_f))
+        return {}
+
+    def fetch(self, feeds, scheme='https://'):
+        '''Fetch feeds and return a list of (feed, parsed, headers) tuples
+           in the order they were passed. parsed is None if the server
+           replied 304 Not Modified or the feed could not be parsed.
+           Pass headers to remember() once all new entries are handled.'''
+        if not self.cache.haskey('feeds'):
+            self.cache.set({}, 'feeds')
+        self.timings = {}
+        _jobs = {}
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for _f in feeds:
+                _jobs[_f] = executor.submit(self.__fetch,
+                    scheme+_f, self.headers(_f))
+        _fetched = []
+        for _f, _job in _jobs.items():
+            try:
+                feed, _elapsed = _job.result()
+            except Exception as msg: #pylint: disable=broad-except
+                self.logger.error("Error fetching %s: %s", _f, str(msg))
+                _fetched.append((_f, None, {}))
+                continue
+            self.timings[_f] = _elapsed
+            self.logger.debug("Fetched %s in %.2f s (status %s).",
+                _f, _elapsed, feed.get('status', 'unknown'))
+            if feed.get('status') == 304:
+                self.logger.debug("%s has not changed since the last run.", _f)
+                metrics.count('feed.notmodified')
+                _fetched.append((_f, None, {}))
+                continue
+            if feed['bozo'] == 1:
+                self.logger.error(feed['bozo_exception'])
+                _fetched.append((_f, None, {}))
+                continue
+            metrics.count('feed.entries', len(feed['entries']))
+            _headers = {}
+            for _key in ('etag', 'modified'):
+                if feed.get(_key):
+                    _headers[_key] = feed[_key]
+            _fetched.append((_f, feed, _headers))
+        self.logtimings()
+        return _fetched
+
+    def remember(self, _f, headers):
+        '''Send headers with the next fetch of a feed. Only call this when
+           every new entry of the feed made it into the cache, or the
+           next fetch gets a 304 and never sees the failed entries again.'''
+        if headers:
+            self.cache.set(headers, 'feeds', hashstring(_f))
+
+    def logtimings(self, slowest=5):
+        '''Log the slowest feeds of the last fetch.'''
+        if not self.timings:
+            return
+        self.logger.info("Fetched %s feeds, slowest:", len(self.timings))
+        for _f in sorted(self.timings, key=self.timings.get, reverse=True)[:slowest]:
+            self.logger.info("  %.2f s %s", self.timings[_f], _f)
+
+def newentries(entries, known, lookback=5):
+    '''Yield the entries of a newest-first feed that are not known yet,
+       stopping after lookback consecutive known entries. A lookback of
+       a few entries tolerates feeds that reorder or edit old posts;
+       0 reads the whole feed.'''
+    _known = 0
+    for entry in entries:
+        if not known(entry):
+            _known = 0
+            metrics.count('feed.new')
+            yield entry
+            continue
+        _known += 1
+        if lookback and _known >= lookback:
+            return
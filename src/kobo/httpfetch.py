@@ -0,0 +1,142 @@
+'''Fetch public substack posts over plain HTTP instead of with Firefox.'''
+
+import sys
+import re
+import html
+import logging
+import html.parser
+
+try:
+    import requests
+except ImportError as msg:
+    print("Error loading pacakge %s" , str(msg))
+    sys.exit()
+
+USERAGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:89.0) Gecko/20100101 Firefox/89.0'
+VOID_ELEMENTS = ('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                 'link', 'meta', 'param', 'source', 'track', 'wbr')
+TAG_RE = re.compile('<[^>]*>')
+
+class ArticleParser(html.parser.HTMLParser):
+    '''Pull the raw inner html of <head>, the first <h1>, the article
+       (class "markup") and the paywall out of a substack page.'''
+
+    def __init__(self, source):
+        super().__init__(convert_charrefs=True)
+        self.source = source
+        self.found = {}
+        self.__stack = []
+        # getpos() counts lines by '\n' only
+        self.__lines = [0]
+        _newline = source.find('\n')
+        while _newline != -1:
+            self.__lines.append(_newline + 1)
+            _newline = source.find('\n', _newline + 1)
+        self.feed(source)
+        self.close()
+
+    def __offset(self):
+        _line, _col = self.getpos()
+        return self.__lines[_line - 1] + _col
+
+    def __target(self, tag, attrs):
+        '''Name of the part of the page this tag holds, if any.'''
+        _classes = (dict(attrs).get('class') or '').split()
+        for _name, _match in (('head', tag == 'head'),
+                              ('title', tag == 'title'),
+                              ('h1', tag == 'h1'),
+                              ('markup', 'markup' in _classes),
+                              ('paywall', 'paywall' in _classes)):
+            if _match and _name not in self.found:
+                return _name
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            return
+        _start = self.__offset() + len(self.get_starttag_text())
+        self.__stack.append((tag, _start, self.__target(tag, attrs)))
+
+    def handle_endtag(self, tag):
+        if tag not in [_tag for _tag, _, _ in self.__stack]:
+            return
+        _end = self.__offset()
+        while self.__stack:
+            _tag, _start, _target = self.__stack.pop()
+            if _target is not None and _target not in self.found:
+                self.found[_target] = self.source[_start:_end]
+            if _tag == tag:
+                break
+
+    def text(self, name):
+        '''Text content of a captured part, with entities like &amp; decoded.'''
+        return html.unescape(TAG_RE.sub('', self.found.get(name, ''))).strip()
+
+class HttpFetcher():
+    '''Fetch and extract substack posts with pooled keep-alive HTTP
+       sessions (one per domain) carrying the cookies from the cache.'''
+
+    def __init__(self, cache, useropts, timeout=15, throttle=None):
+        self.logger = logging.getLogger(__name__)
+        self.cache = cache
+        self.useropts = useropts
+        self.timeout = timeout
+        self.throttle = throttle
+        self.sessions = {}
+
+    def session(self, domain):
+        '''Return the keep-alive session for domain.'''
+        if domain not in self.sessions:
+            _session = requests.Session()
+            _adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+            _session.mount('https://', _adapter)
+            _session.mount('http://', _adapter)
+            _session.headers['User-Agent'] = USERAGENT
+            if self.useropts.get('HTTPPROXY'):
+                _session.proxies = {'http': 'http://%s' % self.useropts['HTTPPROXY'],
+                                    'https': 'http://%s' % self.useropts['HTTPPROXY']}
+            if self.cache.has(domain, 'cookies'):
+                for _cookie in self.cache.get('cookies', domain):
+                    _session.cookies.set(_cookie['name'], _cookie['value'],
+                        domain=_cookie.get('domain', domain),
+                        path=_cookie.get('path', '/'))
+            self.sessions[domain] = _session
+        return self.sessions[domain]
+
+    def fetch(self, domain, url):
+        '''Return an ArticleParser for url, or None if the post has to be
+           rendered in the browser (paywall, CAPTCHA, missing article).'''
+        try:
+            _res = self.session(domain).get(url, timeout=self.timeout)
+        except requests.exceptions.RequestException as msg:
+            self.logger.debug("HTTP fetch of %s failed: %s", url, str(msg))
+            return None
+        if _res.status_code in (429, 503) and self.throttle is not None:
+            _retry = _res.headers.get('Retry-After', '')
+            self.throttle.pushback(domain, 'HTTP %s' % _res.status_code,
+                int(_retry) if _retry.isdigit() else None)
+        if _res.status_code != 200:
+            self.logger.debug("HTTP fetch of %s returned %s.", url, _res.status_code)
+            return None
+        article = ArticleParser(_res.text)
+        if 'captcha' in article.text('title').lower():
+            self.logger.debug("%s looks like a CAPTCHA page.", url)
+            if self.throttle is not None:
+                self.throttle.pushback(domain, 'CAPTCHA')
+            return None
+        if 'this post is for paying subscribers' in article.text('paywall').lower():
+            self.logger.debug("%s is paywalled over HTTP.", url)
+            return None
+        if not article.text('markup'):
+            self.logger.debug("No article found in %s over HTTP.", url)
+            return None
+        if 'This is an excerpt from today’s subscriber-only post' in article.text('markup'):
+            self.logger.debug("Only got an excerpt of %s over HTTP.", url)
+            return None
+        return article
+
+    def close(self):
+        '''Close all sessions.'''
+        for _session in self.sessions.values():
+            _session.close()
+        self.sessions = {}
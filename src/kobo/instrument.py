@@ -0,0 +1,112 @@
+'''
+Run-level timers and counters. Everything records into the module-level
+metrics object, which main writes out as one json line per run next to
+the log file.
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import datetime
+import threading
+import functools
+import contextlib
+import collections
+from .constants import STRFTIME
+
+class Metrics():
+    '''Thread-safe named timers (count, total and max seconds)
+       and counters for one run.'''
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timers = {}
+        self.counters = collections.Counter()
+
+    def add(self, name, elapsed):
+        '''Record elapsed seconds for timer name.'''
+        with self.lock:
+            _timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            _timer[0] += 1
+            _timer[1] += elapsed
+            _timer[2] = max(_timer[2], elapsed)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        '''Time the body of a with statement.'''
+        _start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - _start)
+
+    def timed(self, name):
+        '''Decorator that times every call of a function.'''
+        def _decorator(func):
+            @functools.wraps(func)
+            def _timed(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return _timed
+        return _decorator
+
+    def count(self, name, n=1):
+        '''Add n to counter name.'''
+        with self.lock:
+            self.counters[name] += n
+
+    def summary(self):
+        '''Return the metrics of the run as a dict.'''
+        with self.lock:
+            return {'started': datetime.datetime.fromtimestamp(
+                        self.started).strftime(STRFTIME),
+                    'elapsed': round(time.time() - self.started, 3),
+                    'timers': {_name: {'count': _count,
+                                       'total': round(_total, 3),
+                                       'mean': round(_total/_count, 3),
+                                       'max': round(_max, 3)}
+                               for _name, (_count, _total, _max)
+                               in sorted(self.timers.items())},
+                    'counters': dict(sorted(self.counters.items()))}
+
+    def report(self, report_fn, **extra):
+        '''Append the summary of the run as a json line to report_fn.'''
+        _summary = self.summary()
+        _summary.update(extra)
+        try:
+            with open(report_fn, 'at') as _fh:
+                _fh.write(json.dumps(_summary)+'\n')
+        except OSError as msg:
+            self.logger.warning("Could not write run report %s: %s", report_fn, str(msg))
+            return
+        self.logger.debug("Wrote run report to %s", report_fn)
+
+    def log(self, _logger=None):
+        '''Log the timers, slowest first, and the counters.'''
+        _logger = _logger or self.logger
+        _summary = self.summary()
+        _logger.info("Run took %.1f s.", _summary['elapsed'])
+        for _name, _timer in sorted(_summary['timers'].items(),
+                key=lambda _item: _item[1]['total'], reverse=True):
+            _logger.info("%-20s %5s x  mean %.2f s  max %.2f s  total %.1f s",
+                _name, _timer['count'], _timer['mean'], _timer['max'], _timer['total'])
+        for _name, _count in _summary['counters'].items():
+            _logger.info("%-20s %5s", _name, _count)
+
+    def reset(self):
+        '''Start a new run.'''
+        with self.lock:
+            self.started = time.time()
+            self.timers = {}
+            self.counters = collections.Counter()
+
+metrics = Metrics()
+
+def reportfn(logdir, ext):
+    '''Name of a file next to the log file of this run.'''
+    return os.path.join(logdir,
+        os.path.basename(sys.argv[0]).split('.')[0]+ext)
@@ -0,0 +1,143 @@
+'''Check in bulk that links still load and remember the answer for a while.'''
+import sys
+import time
+import logging
+import datetime
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from .util import hashstring
+from .constants import STRFTIME
+from .httpfetch import USERAGENT
+from .instrument import metrics
+
+try:
+    import requests
+except ImportError as msg:
+    print("Error loading pacakge %s" , str(msg))
+    sys.exit()
+
+# Servers that refuse HEAD tend to answer with one of these
+HEAD_REFUSED = (403, 405, 501)
+# Seconds between sweeps of expired results (once per run, hourly in --daemon)
+EXPIRE_EVERY = 3600
+
+class LinkChecker():
+    '''Check links concurrently with HEAD (falling back to a streamed GET)
+       over keep-alive sessions per host, and cache the results in the
+       'linkcheck' key for ttl hours.'''
+
+    def __init__(self, cache, threads=8, per_host=2, timeout=10, ttl=24):
+        self.logger = logging.getLogger(__name__)
+        self.cache = cache
+        self.threads = max(1, threads)
+        self.per_host = max(1, per_host)
+        self.timeout = (min(5, timeout), timeout)
+        self.ttl = datetime.timedelta(hours=ttl)
+        self.sessions = {}
+        self.checked = {}
+        self.expired = 0
+        self.__hostlocks = {}
+        self.__lock = threading.Lock()
+
+    def __host(self, url):
+        '''Return the session and semaphore for the host of url.'''
+        _host = urllib.parse.urlparse(url).netloc
+        with self.__lock:
+            if _host not in self.sessions:
+                _session = requests.Session()
+                _adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.per_host)
+                _session.mount('https://', _adapter)
+                _session.mount('http://', _adapter)
+                _session.headers['User-Agent'] = USERAGENT
+                self.sessions[_host] = _session
+                self.__hostlocks[_host] = threading.BoundedSemaphore(self.per_host)
+            return self.sessions[_host], self.__hostlocks[_host]
+
+    def __check(self, url):
+        '''Return True/False if url loads or not, None on network errors
+           (runs in a worker thread). Urls that requests cannot even send
+           count as not loading, they will not work next time either.'''
+        _session, _hostlock = self.__host(url)
+        with _hostlock:
+            try:
+                _res = _session.head(url, allow_redirects=True, timeout=self.timeout)
+                if _res.status_code in HEAD_REFUSED:
+                    with _session.get(url, allow_redirects=True, stream=True,
+                            timeout=self.timeout) as _res:
+                        pass
+            except (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                    requests.exceptions.InvalidSchema) as msg:
+                self.logger.debug("Not checking %s: %s", url, str(msg))
+                return False
+            except requests.exceptions.RequestException as msg:
+                self.logger.debug("Error checking %s: %s", url, str(msg))
+                return None
+        self.logger.debug("%s returned %s.", url, _res.status_code)
+        return _res.status_code < 400
+
+    def cached(self, url):
+        '''Return the cached result for url or None if it is missing or expired.'''
+        if not self.cache.haskey('linkcheck', hashstring(url)):
+            return None
+        _valid, _checked = self.cache.get('linkcheck', hashstring(url))
+        if datetime.datetime.now() - datetime.datetime.strptime(_checked, STRFTIME) > self.ttl:
+            return None
+        return _valid
+
+    def check(self, urls):
+        '''Check urls in parallel and return a dict of url: valid, where
+           valid is None if the url could not be checked this run.'''
+        if not self.cache.haskey('linkcheck'):
+            self.cache.set({}, 'linkcheck')
+        if time.time() - self.expired > EXPIRE_EVERY:
+            self.expire()
+        checked = {}
+        _jobs = {}
+        _start = time.time()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for _url in dict.fromkeys(urls):
+                if _url in self.checked:
+                    checked[_url] = self.checked[_url]
+                    continue
+                _valid = self.cached(_url)
+                if _valid is not None:
+                    checked[_url] = _valid
+                else:
+                    _jobs[_url] = executor.submit(self.__check, _url)
+        _now = datetime.datetime.now().strftime(STRFTIME)
+        for _url, _job in _jobs.items():
+            _valid = _job.result()
+            checked[_url] = self.checked[_url] = _valid
+            if _valid is None:
+                # Only remember timeouts and connection errors until expire()
+                continue
+            self.cache.set([_valid, _now], 'linkcheck', hashstring(_url))
+        if _jobs:
+            metrics.add('linkcheck', time.time() - _start)
+            metrics.count('linkcheck.checked', len(_jobs))
+            self.logger.info("Checked %s links in %.1f s (%s cached).",
+                len(_jobs), time.time() - _start, len(checked) - len(_jobs))
+        return checked
+
+    def valid(self, url):
+        '''Check a single link (None if it could not be checked).'''
+        return self.check([url])[url]
+
+    def expire(self):
+        '''Drop expired results from the cache and forget the results of
+           this run, so --daemon checks links again every EXPIRE_EVERY s.'''
+        self.checked = {}
+        _links = self.cache.get('linkcheck')
+        _cutoff = (datetime.datetime.now() - self.ttl).strftime(STRFTIME)
+        self.expired = time.time()
+        if any(_links[_key][1] < _cutoff for _key in _links):
+            self.cache.set({_key: _val for _key, _val in _links.items()
+                if _val[1] >= _cutoff}, 'linkcheck')
+
+    def close(self):
+        '''Close all sessions.'''
+        for _session in self.sessions.values():
+            _session.close()
+        self.sessions = {}
@@ -7,14 +7,20 @@ The PDFs are formatted to read on a Kobo e-reader.
 import sys
 import os
 import time
+import signal
+import cProfile
+import functools
 import logging
 import logging.config
 from .options import parseopts
-from .dosubstack import DoSubstack
 from .cache import Cache
-from .pocket import DoPocket
-from .dropbox import DoDropbox
+from .sqlitecache import SqliteCache
 from .util import cleancache, configtodict
+from .instrument import metrics, reportfn
+# The clients (and selenium, dropbox, pdfkit, feedparser, pocket and
+# pushover with them) are imported when a command first needs them,
+# so cache maintenance commands start quickly and need no credentials.
+# pylint: disable=import-outside-toplevel
 
 try:
     import colorama as cm
@@ -67,17 +73,12 @@ if config is None:
     logger.info("Default file created at %s", opts.configdir)
     sys.exit()
 
-cache = Cache(opts)
-if opts.clean:
-    cleancache(cache, config)
-if opts.reset:
-    if not opts.cacheonly:
-        logger.warning('Reseting cache without --cacheonly is dangerous.')
-        time.sleep(5)
-    cache.reset('links')
-if opts.dedupe:
-    cache.dedupe()
-    logger.info("%s links in cache", len(cache.get('links')))
+opts.compactlinks = opts.compactlinks \
+    or config['USEROPTS'].get('COMPACTLINKS', 'False').lower() == 'true'
+if (opts.cachebackend or config['USEROPTS'].get('CACHEBACKEND', 'json')).lower() == 'sqlite':
+    cache = SqliteCache(opts)
+else:
+    cache = Cache(opts)
 
 try:
     # For pdfkit?
@@ -86,29 +87,83 @@ try:
 except KeyError as msg:
     logger.warning("Couldn't set XDG_RUNTIME_DIR. %s" , str(msg))
 
-# Our three main classes for pocket, dropbox and substack
-pocket = DoPocket(cache, opts, config)
-dropbox = DoDropbox(opts, config)
-substack = DoSubstack(opts, config, cache)
+class Clients():
+    '''Our three main classes for pocket, dropbox and substack,
+       imported and built the first time they are used.'''
+
+    def __init__(self):
+        self.built = {}
+
+    @property
+    def pocket(self):
+        '''The DoPocket client.'''
+        if 'pocket' not in self.built:
+            from .pocket import DoPocket
+            self.built['pocket'] = DoPocket(cache, opts, config)
+        return self.built['pocket']
+
+    @property
+    def dropbox(self):
+        '''The DoDropbox client.'''
+        if 'dropbox' not in self.built:
+            from .dropbox import DoDropbox
+            self.built['dropbox'] = DoDropbox(opts, config, cache)
+        return self.built['dropbox']
+
+    @property
+    def substack(self):
+        '''The DoSubstack client.'''
+        if 'substack' not in self.built:
+            from .dosubstack import DoSubstack
+            from .throttle import Throttle
+            # One throttle for every worker slot, so that slots share
+            # the login tokens and backoff of each domain
+            self.built['substack'] = DoSubstack(opts, config, cache,
+                throttle=Throttle(cache, opts.throttlewait))
+        return self.built['substack']
+
+clients = Clients()
+
+def maintenance(command):
+    '''Clean, reset or dedupe the cache if the command
+       or the --clean, --reset and --dedupe flags ask for it.'''
+    if opts.clean or command == 'clean':
+        cleancache(cache, config)
+        cache.save()
+    if opts.reset or command == 'reset':
+        if not opts.cacheonly:
+            logger.warning('Reseting cache without --cacheonly is dangerous.')
+            time.sleep(5)
+        cache.reset('links')
+    if opts.dedupe or command == 'dedupe':
+        cache.dedupe()
+        cache.save()
+        logger.info("%s links in cache", len(cache.get('links')))
+
+def prune():
+    '''Prune the PDFs older than --prunedropbox days from Dropbox.'''
+    if not opts.prunedropbox:
+        logger.error("Pass the number of days to keep with --prunedropbox.")
+        return
+    clients.dropbox.prunedropbox(opts.prunedropbox)
+    cache.save()
+    clients.dropbox.cleanup()
 
 def pocketloop():
     '''Crawl an rss feed and cache the links to pocket.'''
 
     logger.info("Starting RSS run.")
-    p_cached = pocket.rsstopocket(list(config['RSS FEEDS']))
+    p_cached = clients.pocket.rsstopocket(list(config['RSS FEEDS']))
     logger.info("Cached %s urls to pocket.", p_cached.count(True))
     if True in p_cached or opts.cacheonly:
         cache.save()
 
-def substackloop():
-    '''Substacks rendered to html on Morty
-        send to Pocket rendered to PDFs
-        and uploaded to Dropbox'''
-
-    logger.info("Starting Substack run.")
+def ssentries():
+    '''Build the substack entries from the config.'''
+    from .dropbox import DoDropbox
     pdfopts = configtodict(config['PDFOPTIONS'],
         DoDropbox.PDFOPTIONS)
-    ss_cached = []
+    ss_entries = []
     for _ss in config['SUBSTACKS']:
         _f = {'domain': config['SUBSTACKS'][_ss],
               'fontsize': pdfopts['minimum-font-size'],
@@ -120,16 +175,30 @@ def substackloop():
             for _key in ('fontsize', 'login', 'password'):
                 if _key in config[_ss]:
                     _f[_key] = config[_ss][_key]
+        ss_entries.append(_f)
+    return ss_entries
 
-        pdfs = substack.parse_ss_entry(_f)
-        for _uri, _pdf_uri, _title in pdfs:
-            if _pdf_uri is not None:
-                pocket.savetopocket(_f['domain'], _uri,  _title)
-            if not opts.cacheonly and _pdf_uri is not None:
-                logger.debug("Attempting to upload %s from %s to dropbox."
-                        , _pdf_uri, _f['domain'])
-                ss_cached.append(dropbox.pdftodropbox(_pdf_uri,
-                            pdfopts, _f['fontsize']))
+def sspipeline(ss_entries, ss_fetchers=None):
+    '''Run ss_entries through fetch -> render -> upload -> pocket,
+       each on its own threads, and return the posts that were processed.'''
+    from .dropbox import DoDropbox
+    from .pipeline import Pipeline
+    from .ssworkers import SubstackWorkers
+    pdfopts = configtodict(config['PDFOPTIONS'],
+        DoDropbox.PDFOPTIONS)
+    if ss_fetchers is None:
+        ss_fetchers = SubstackWorkers(opts, config, cache,
+            clients.substack, opts.ssworkers).substacks
+    ss_pipeline = Pipeline(opts.queuesize)
+    ss_pipeline.stage('fetch', [functools.partial(ssfetch, _fetcher)
+        for _fetcher in ss_fetchers])
+    ss_pipeline.stage('render', functools.partial(ssrender, pdfopts), opts.renderers)
+    ss_pipeline.stage('upload', ssupload, opts.uploaders)
+    ss_pipeline.stage('pocket', sspocket)
+    ss_items = ss_pipeline.run(ss_entries)
+
+    clients.pocket.flush()
+    ss_cached = [_item['uploaded'] for _item in ss_items if _item['uploaded'] is not None]
 
     logger.info("Cached %s substacks to Dropbox.", ss_cached.count(True))
 
@@ -137,8 +206,138 @@ def substackloop():
         cache.save()
     if False in ss_cached:
         logger.warning("There were errors uploading PDFs to dropbox.")
-    substack.cleanup()
+    return ss_items
+
+def substackloop():
+    '''Substacks rendered to html on Morty
+        send to Pocket rendered to PDFs
+        and uploaded to Dropbox'''
+
+    logger.info("Starting Substack run.")
+    sspipeline(ssentries())
+    clients.substack.cleanup()
     if opts.prunedropbox:
-        dropbox.prunedropbox(opts.prunedropbox)
-    dropbox.cleanup()
+        clients.dropbox.prunedropbox(opts.prunedropbox)
+        cache.save()
+    clients.dropbox.cleanup()
     logger.info("#### Done ####")
+
+def ssfetch(fetcher, ss_entry):
+    '''Pipeline stage: fetch the new posts of a substack.'''
+    for _uri, _pdf_uri, _title in fetcher.iter_ss_entry(ss_entry):
+        if _pdf_uri is not None:
+            yield {'entry': ss_entry, 'uri': _uri, 'pdf_uri': _pdf_uri,
+                   'title': _title, 'pdf': None, 'uploaded': None}
+
+def ssrender(pdfopts, item):
+    '''Pipeline stage: render the html of a post to a PDF.'''
+    if not opts.cacheonly and not opts.dryrun:
+        item['pdf'] = clients.dropbox.renderer.render(item['pdf_uri'],
+            pdfopts, item['entry']['fontsize'])
+    return [item]
+
+def ssupload(item):
+    '''Pipeline stage: upload the PDF of a post to Dropbox.'''
+    if opts.cacheonly:
+        return [item]
+    logger.debug("Attempting to upload %s from %s to dropbox."
+            , item['pdf_uri'], item['entry']['domain'])
+    if opts.dryrun:
+        logger.info("But not really because dry-run.")
+        item['uploaded'] = True
+    else:
+        item['uploaded'] = clients.dropbox.upload(item['pdf_uri'], item['pdf'])
+    return [item]
+
+def sspocket(item):
+    '''Pipeline stage: save the link to a post to Pocket.'''
+    clients.pocket.savetopocket(item['entry']['domain'], item['uri'], item['title'])
+    return [item]
+
+def rssjob(rss_feeds):
+    '''Daemon job: send the new links of the RSS feeds that are due
+       to Pocket in one run and return the new entries per feed.'''
+    clients.pocket.rsstopocket(rss_feeds)
+    return clients.pocket.found
+
+def ssjob(ss_fetchers, ss_entry):
+    '''Daemon job: run the new posts of one substack through the pipeline.'''
+    return len(sspipeline([ss_entry], ss_fetchers))
+
+def daemon():
+    '''Stay resident and poll every feed in [RSS FEEDS] and [SUBSTACKS]
+       on its own schedule, keeping the clients, cache and Firefox warm.'''
+    from .scheduler import Scheduler
+    from .ssworkers import SubstackWorkers
+    logger.info("Starting daemon.")
+    scheduler = Scheduler(cache, opts.interval, opts.mininterval, opts.maxinterval)
+    for _f in config['RSS FEEDS']:
+        scheduler.add(_f, rssjob, batch=True)
+    ss_fetchers = SubstackWorkers(opts, config, cache,
+        clients.substack, opts.ssworkers).substacks
+    for ss_entry in ssentries():
+        scheduler.add(ss_entry['domain'], functools.partial(
+            ssjob, ss_fetchers, ss_entry))
+    pruned = 0
+
+    def flush():
+        '''Save the cache, prune Dropbox once a day
+           and write the metrics since the last flush.'''
+        nonlocal pruned
+        cache.save()
+        if opts.prunedropbox and time.time() - pruned > 86400:
+            clients.dropbox.prunedropbox(opts.prunedropbox)
+            cache.save()
+            pruned = time.time()
+        report('daemon')
+        metrics.reset()
+
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    try:
+        scheduler.run(flush, opts.flushinterval * 60)
+    finally:
+        clients.substack.cleanup()
+        clients.dropbox.cleanup()
+        logger.info("#### Done ####")
+
+def report(command):
+    '''Log the metrics and append them to the run report.'''
+    metrics.log(logger)
+    if os.path.isdir(opts.logdir):
+        metrics.report(reportfn(opts.logdir, '.metrics.jsonl'),
+            dryrun=opts.dryrun, cacheonly=opts.cacheonly, command=command)
+
+def run():
+    '''Run the command (by default pocketloop and substackloop), under
+       cProfile with --profile, and append the timers and counters of the
+       run to the report.'''
+    command = 'daemon' if opts.daemon else opts.command
+    maintenance(command)
+    if opts.stopdriver:
+        clients.substack.driverpool.stopall()
+    if command in ('clean', 'reset', 'dedupe'):
+        return
+    profile = cProfile.Profile() if opts.profile else None
+    if profile is not None:
+        profile.enable()
+    try:
+        if command == 'daemon':
+            daemon()
+        elif command == 'prune':
+            prune()
+        else:
+            if command in ('run', 'rss'):
+                pocketloop()
+            if command in ('run', 'substack'):
+                substackloop()
+    finally:
+        if not os.path.isdir(opts.logdir):
+            logger.warning("%s does not exist, not saving the run report.", opts.logdir)
+        elif profile is not None:
+            profile.disable()
+            _prof_fn = reportfn(opts.logdir, time.strftime('-%Y%m%d-%H%M%S.prof'))
+            profile.dump_stats(_prof_fn)
+            logger.info("Saved profile to %s", _prof_fn)
+        if command != 'daemon':
+            report(command)
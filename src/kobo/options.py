@@ -7,12 +7,28 @@ import shutil
 def parseopts():
     '''Parse commandline arguments and config file and return opts, config'''
 
+    # Read user options
+    opts=buildparser().parse_args()
+    config = doconfig(os.path.join(opts.configdir,
+          __package__+'.conf')
+          )
+    return opts,config
+
+def buildparser():
+    '''Return the argument parser for the command line'''
+
     desc='''Crawl RSS feeds and send then to Pocket
           or convert to a PDF and send them to Dropbox.'''
     parser = argparse.ArgumentParser(description=desc,
                                   formatter_class=argparse
                                   .ArgumentDefaultsHelpFormatter)
 
+    parser.add_argument('command', nargs='?', default='run',
+         choices=['run', 'rss', 'substack', 'daemon', 'dedupe', 'clean', 'reset', 'prune'],
+         help="What to do: run does rss and then substack, daemon stays running, "
+              "dedupe, clean and reset only touch the cache, "
+              "prune only prunes dropbox (to --prunedropbox days).")
+
     parser.add_argument('-d','--dryrun', action="store_true", default=False,
          help="Dry-run, do not save anything.")
 
@@ -35,9 +51,20 @@ def parseopts():
          choices=['debug', 'info', 'warning', 'error', 'critical'],
          help="Set the log level (critical, warning, info).")
 
+    parser.add_argument('--profile', action="store_true", default=False,
+         help="Profile the run with cProfile and save the stats in the log dir.")
+
     parser.add_argument('--nocolor', action="store_true", default=False,
          help="Turn off colored output (useful when called from another script.")
 
+    parser.add_argument('--cachebackend', action="store", default=None,
+        choices=['json', 'sqlite'],
+        help="Storage backend for the cache (overrides CACHEBACKEND in the config).")
+
+    parser.add_argument('--compactlinks', action="store_true", default=False,
+        help="Store only digests of the links in the cache "
+             "(cannot be undone; overrides COMPACTLINKS in the config).")
+
     parser.add_argument('--dedupe', action="store_true", default=False,
          help="Dedupe the cache.")
 
@@ -51,20 +78,84 @@ def parseopts():
         choices=[1,2,3,4,5,6,7,8,9,10,11,12,13,14],
        help="Prune dropbox to a number of days between 1-14.")
 
-    parser.add_argument('--loginurls', action="store", nargs='*',
-       help="Custom login urls in the form 'domain;url' for substacks, e.g., to bypass CAPTCHA.")
+    parser.add_argument('--relistdropbox', action="store_true", default=False,
+       help="List the Dropbox folder when pruning instead of trusting the local manifest.")
+
+    parser.add_argument('--fetchthreads', action="store", type=int, default=8,
+       help="Number of rss feeds to download in parallel.")
+
+    parser.add_argument('--lookback', action="store", type=int, default=5,
+       help="Stop reading a feed after this many entries in a row "
+            "that are already cached (0 reads whole feeds).")
+
+    parser.add_argument('--linkttl', action="store", type=int, default=24,
+       help="Hours to remember whether a link loaded before checking it again.")
+
+    parser.add_argument('--warmdriver', action="store_true", default=False,
+       help="Keep Firefox running between runs and reattach to it.")
+
+    parser.add_argument('--driverpages', action="store", type=int, default=200,
+       help="Restart Firefox after loading this many pages.")
+
+    parser.add_argument('--drivermem', action="store", type=int, default=1500,
+       help="Restart Firefox when it uses more than this many MB.")
+
+    parser.add_argument('--stopdriver', action="store_true", default=False,
+       help="Stop Firefox sessions kept warm by --warmdriver.")
+
+    parser.add_argument('--pagetimeout', action="store", type=int, default=15,
+       help="Maximum seconds to wait for a substack page to become ready.")
+
+    parser.add_argument('--logintimeout', action="store", type=int, default=30,
+       help="Maximum seconds to wait for a substack login to complete.")
+
+    parser.add_argument('--throttlewait', action="store", type=int, default=30,
+       help="Maximum seconds to wait for a substack that is being rate "
+            "limited before skipping it for this run.")
+
+    parser.add_argument('--browseronly', action="store_true", default=False,
+       help="Always render substacks in Firefox, never over plain HTTP.")
+
+    parser.add_argument('--ssworkers', action="store", type=int, default=1,
+       help="Number of Firefox instances that render substacks in parallel.")
+
+    parser.add_argument('--renderers', action="store", type=int, default=2,
+       help="Number of PDFs to render in parallel.")
+
+    parser.add_argument('--pdfcachesize', action="store", type=int, default=200,
+       help="Size in MB of the cache of rendered PDFs (0 to disable).")
+
+    parser.add_argument('--uploaders', action="store", type=int, default=2,
+       help="Number of PDFs to upload to Dropbox in parallel.")
+
+    parser.add_argument('--queuesize', action="store", type=int, default=8,
+       help="Number of posts that may wait between two stages of the substack pipeline.")
+
+    parser.add_argument('--daemon', action="store_true", default=False,
+       help="Stay running and poll each feed on its own schedule instead of once per run.")
+
+    parser.add_argument('--interval', action="store", type=int, default=60,
+       help="Minutes between polls of a feed in --daemon mode until it has published something.")
+
+    parser.add_argument('--mininterval', action="store", type=int, default=15,
+       help="Never poll a feed more often than every this many minutes in --daemon mode.")
+
+    parser.add_argument('--maxinterval', action="store", type=int, default=720,
+       help="Poll every feed at least every this many minutes in --daemon mode.")
+
+    parser.add_argument('--flushinterval', action="store", type=int, default=10,
+       help="Minutes between saving the cache and writing metrics in --daemon mode.")
+
+    # One url per flag, so the optional command after it is not taken for a url
+    parser.add_argument('--loginurls', action="append", metavar='LOGINURL',
+       help="Custom login url in the form 'domain;url' for a substack, e.g., "
+            "to bypass CAPTCHA (repeat for more substacks).")
     # for _login in loginurls:
     #     parser.add_argument('--%s' % _login[1] ,
     #                         action="store", metavar='URL',
     #                         help="Add a custom login url for %s." % _login[0])
       # loginurls.append( (_domain,_key) )
-
-    # Read user options
-    opts=parser.parse_args()
-    config = doconfig(os.path.join(opts.configdir,
-          __package__+'.conf')
-          )
-    return opts,config
+    return parser
 
 def doconfig(config_file):
     '''Parse config file or write a default file.'''
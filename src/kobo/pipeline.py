@@ -0,0 +1,87 @@
+'''Run work items through a chain of stages connected by bounded queues.'''
+
+import time
+import queue
+import logging
+import threading
+from .instrument import metrics
+
+DONE = object()
+
+class Stage():
+    '''A step of a Pipeline run by one thread per function in funcs.
+       Each function takes an item and returns an iterable of items for
+       the next stage (a generator, a list, or None to drop the item).'''
+
+    def __init__(self, name, funcs, queuesize):
+        self.name = name
+        self.funcs = funcs
+        self.queue = queue.Queue(maxsize=queuesize)
+        self.running = len(funcs)
+        self.lock = threading.Lock()
+
+class Pipeline():
+    '''Connect stages with bounded queues so that, e.g., fetching the
+       next article, rendering the previous one and uploading the one
+       before that all happen at the same time. A stage that falls behind
+       fills its queue, which blocks the stage before it.'''
+
+    def __init__(self, queuesize=8):
+        self.logger = logging.getLogger(__name__)
+        self.queuesize = max(1, queuesize)
+        self.stages = []
+        self.results = []
+
+    def stage(self, name, func, workers=1):
+        '''Add a stage that runs func on workers threads. func may also be
+           a list with one function per thread, e.g., for workers that each
+           own a webdriver.'''
+        _funcs = list(func) if isinstance(func, (list, tuple)) else [func] * max(1, workers)
+        self.stages.append(Stage(name, _funcs, self.queuesize))
+        return self
+
+    def run(self, items):
+        '''Feed items to the first stage, wait for all stages to finish
+           and return what the last stage produced.'''
+        self.results = []
+        _threads = []
+        for _i, _stage in enumerate(self.stages):
+            _stage.running = len(_stage.funcs)
+            _next = self.stages[_i+1] if _i+1 < len(self.stages) else None
+            for _n, _func in enumerate(_stage.funcs):
+                _thread = threading.Thread(target=self.__work,
+                    args=(_stage, _func, _next),
+                    name='%s-%s' % (_stage.name, _n), daemon=True)
+                _thread.start()
+                _threads.append(_thread)
+        for _item in items:
+            self.stages[0].queue.put(_item)
+        for _ in self.stages[0].funcs:
+            self.stages[0].queue.put(DONE)
+        for _thread in _threads:
+            _thread.join()
+        return self.results
+
+    def __work(self, stage, func, _next):
+        '''Worker thread: run func on items until the stage is done,
+           then tell the next stage once all workers of this one are.'''
+        while True:
+            _item = stage.queue.get()
+            if _item is DONE:
+                break
+            _start = time.time()
+            try:
+                for _out in func(_item) or ():
+                    if _next is None:
+                        self.results.append(_out)
+                    else:
+                        _next.queue.put(_out)
+            except Exception as msg: #pylint: disable=broad-except
+                self.logger.error("Error in %s stage: %s", stage.name, str(msg))
+            metrics.add('pipeline.'+stage.name, time.time() - _start)
+        with stage.lock:
+            stage.running -= 1
+            _last = stage.running == 0
+        if _last and _next is not None:
+            for _ in _next.funcs:
+                _next.queue.put(DONE)
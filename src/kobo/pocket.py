@@ -1,17 +1,26 @@
 '''Handle parsing an rss feed and uploading the links to pocket'''
 import sys
+import time
 import logging
-from .util import hashstring, checkurl
+from .util import hashstring
+from .feeds import FeedFetcher, newentries
+from .linkcheck import LinkChecker
+from .instrument import metrics
 
 try:
     from pocket import Pocket, PocketException
-    import feedparser
+    from pocket import RateLimitException, ServerMaintenanceException
 except ImportError as msg:
     print("Error loading pacakge %s" , str(msg))
     sys.exit()
 
 class DoPocket():
     '''A class for fetching links and sending them to pocket.'''
+
+    # Links are sent to the bulk /v3/send endpoint in batches of this size
+    BATCH_SIZE = 50
+    BATCH_RETRIES = 5
+
     def __init__(self, cache, opts, config):
         self.logger = logging.getLogger(__name__)
         self.opts = opts
@@ -19,50 +28,132 @@ class DoPocket():
         self.pocket_instance = Pocket(
             config['USEROPTS']['CONSUMER_KEY'],
             config['USEROPTS']['ACCESS_TOKEN'])
+        self.fetcher = FeedFetcher(cache, opts.fetchthreads)
+        self.checker = LinkChecker(cache, opts.fetchthreads, ttl=opts.linkttl)
+        self.pending = []
+        self.queued = set()
+        self.sent = []
+        # New entries per feed found by the last rsstopocket
+        self.found = {}
 
     def savetopocket(self, _f, _link, _title=''):
-        '''Save a link to pocket and cache the result.'''
+        '''Queue a link for pocket and cache the result when it is sent.
+        Returns False if the link is skipped, True if it was cached and
+        None if it was queued for the next flush().'''
         _title = _title or 'Morty'
         if not self.cache.haskey('links', hashstring(_f)):
             self.cache.set([], 'links', hashstring(_f))
             self.logger.info("Adding new key for %s in links.", _f)
         if self.cache.has(_link, 'links', hashstring(_f)):
             return False
-        if not checkurl(_link):
+        if (_f, _link) in self.queued:
+            return False
+        _valid = self.checker.valid(_link)
+        if _valid is None:
+            self.logger.warning("Not saving %s to pocket because it could not be checked.", _link)
+            return False
+        if not _valid:
             self.logger.warning("Not saving %s to pocket because it did not load.", _link)
             return False
         if not self.opts.cacheonly:
             self.logger.debug('Saving %s (%s) to Pocket' , _f, _link)
             if not self.opts.dryrun:
-                try:
-                    _, _ = self.pocket_instance.add(_link, title=_title)
-                    self.cache.append_unique(_link, 'links', hashstring(_f))
-                    return True
-                except PocketException as msg:
-                    self.logger.error("Error adding %s to pocket: %s", _link, str(msg))
-                except AttributeError:
-                    self.logger.error("No pocket instance, not saving.")
+                self.pending.append((_f, _link, _title))
+                self.queued.add((_f, _link))
+                if len(self.pending) >= self.BATCH_SIZE:
+                    self.__sendbatch()
+                return None
         else:
             self.logger.debug('Caching %s (%s) to Pocket' , _title, _link)
             self.cache.append_unique(_link, 'links', hashstring(_f))
             return True
         return False
 
+    def flush(self):
+        '''Send the queued links to pocket and return a list of
+        True/False for every link sent since the last flush.'''
+        while self.pending:
+            self.__sendbatch()
+        _sent, self.sent = self.sent, []
+        self.queued = set()
+        return _sent
+
+    def __sendbatch(self):
+        '''Send one batch of queued links with the bulk action api and
+        cache the links that pocket accepted.'''
+        _batch = self.pending[:self.BATCH_SIZE]
+        self.pending = self.pending[self.BATCH_SIZE:]
+        _backoff = 1
+        for _try in range(self.BATCH_RETRIES):
+            try:
+                for _f, _link, _title in _batch:
+                    self.pocket_instance.bulk_add(None, url=_link, title=_title)
+                _res, _ = self.pocket_instance.commit()
+                break
+            except (RateLimitException, ServerMaintenanceException) as msg:
+                if _try == self.BATCH_RETRIES - 1:
+                    self.logger.error("Giving up sending %s links to pocket: %s",
+                        len(_batch), str(msg))
+                    _res = {}
+                    break
+                self.logger.warning("Pocket is rate limiting (%s), retrying in %s s.",
+                    str(msg), _backoff)
+                time.sleep(_backoff)
+                _backoff *= 2
+            except PocketException as msg:
+                self.logger.error("Error adding %s links to pocket: %s", len(_batch), str(msg))
+                _res = {}
+                break
+            except AttributeError:
+                self.logger.error("No pocket instance, not saving.")
+                _res = {}
+                break
+        _results = _res.get('action_results', []) if isinstance(_res, dict) else []
+        for _i, (_f, _link, _title) in enumerate(_batch):
+            if _i < len(_results) and _results[_i]:
+                self.cache.append_unique(_link, 'links', hashstring(_f))
+                self.sent.append(True)
+                metrics.count('pocket.sent')
+            else:
+                self.logger.error("Pocket did not add %s.", _link)
+                self.sent.append(False)
+                metrics.count('pocket.failed')
+        self.logger.info("Sent %s links to pocket, %s failed.",
+            len(_batch), self.sent[-len(_batch):].count(False))
+
     def rsstopocket(self, rss_feeds):
         '''Crawl and RSS feed and upload URLs to Pocket'''
-        _cached = []
-        for _f in rss_feeds:
-            feed = feedparser.parse('https://'+_f)
-            if feed['bozo'] == 1:
-                self.logger.error(feed['bozo_exception'])
+        _items = []
+        self.found = {}
+        _fetched = self.fetcher.fetch(rss_feeds)
+        for _f, feed, _ in _fetched:
+            if feed is None:
                 continue
-            for item in feed['entries']:
+            for item in newentries(feed['entries'],
+                    lambda _item, _f=_f: self.cache.has(_item['link'], 'links', hashstring(_f)),
+                    self.opts.lookback):
                 if 'title' in item:
                     title = item['title']
                 else:
                     title = 'No Title'
-                _cached.append(
-                        self.savetopocket(_f,
-                                    item['link'], title)
-                                    )
+                _items.append((_f, item['link'], title))
+                self.found[_f] = self.found.get(_f, 0) + 1
+        # Check all new links at once; savetopocket then hits the cached results
+        _checked = self.checker.check([_link for _f, _link, _ in _items
+            if not self.cache.has(_link, 'links', hashstring(_f))])
+        _cached = []
+        for _f, _link, title in _items:
+            _cached.append(
+                    self.savetopocket(_f,
+                                _link, title)
+                                )
+        _cached = [_res for _res in _cached if _res is not None] + self.flush()
+        # A feed is done when each new entry was cached or its link is dead;
+        # entries left by a timeout or a pocket error need the next fetch
+        for _f, feed, _headers in _fetched:
+            if feed is not None and not self.opts.dryrun and all(
+                    _checked.get(_link) is False or
+                    self.cache.has(_link, 'links', hashstring(_f))
+                    for _item_f, _link, _ in _items if _item_f == _f):
+                self.fetcher.remember(_f, _headers)
         return _cached
@@ -0,0 +1,178 @@
+'''Render html files to PDFs with wkhtmltopdf and cache the results.'''
+
+import os
+import sys
+import json
+import collections
+import hashlib
+import logging
+import tempfile
+import threading
+from .instrument import metrics
+
+try:
+    import pdfkit
+except ImportError as msg:
+    print("Error loading pacakge %s" , str(msg))
+    sys.exit()
+
+logger = logging.getLogger(__name__)
+
+class PdfRenderer():
+    '''Render PDFs through an optional PdfCache. render() is thread-safe,
+       the render stage of the substack pipeline runs one wkhtmltopdf
+       per thread.'''
+
+    def __init__(self, pdfcache=None):
+        self.pdfcache = pdfcache
+
+    def render(self, uri, pdfopts, fontsize=None):
+        '''Render uri in the calling thread, or return the cached PDF
+           if the same html was rendered with the same options before.'''
+        if self.pdfcache is None:
+            return uritopdf(uri, pdfopts, fontsize)
+        _key = self.pdfcache.key(uri, pdfopts, fontsize)
+        _fn = self.pdfcache.get(_key)
+        if _fn is None:
+            _fn = uritopdf(uri, pdfopts, fontsize, self.pdfcache.path)
+            if _fn is not None:
+                _fn = self.pdfcache.put(_key, _fn)
+        else:
+            metrics.count('pdf.cached')
+        return _fn
+
+    def release(self, pdf_fn):
+        '''Call when done with a rendered PDF; removes it unless it is
+           cached, in which case it may be evicted again.'''
+        if self.pdfcache is not None and self.pdfcache.holds(pdf_fn):
+            self.pdfcache.unpin(pdf_fn)
+            return
+        os.remove(pdf_fn)
+
+    def shutdown(self):
+        '''Log the PDF cache counters.'''
+        if self.pdfcache is not None:
+            self.pdfcache.log()
+
+class PdfCache():
+    '''Content-addressed on-disk cache of rendered PDFs keyed by the html,
+       the resolved pdf options and the font size, with LRU eviction
+       once the cache grows past maxsize MB. PDFs handed out by get()
+       and put() are pinned until unpin(), so another render thread
+       never evicts a PDF that is still waiting to be uploaded.'''
+
+    def __init__(self, cachedir, maxsize=200):
+        self.path = os.path.join(cachedir, 'kobo-pdfs')
+        self.maxsize = maxsize * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.__pinned = collections.Counter()
+        self.__lock = threading.Lock()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def key(self, uri, pdfopts, fontsize=None):
+        '''Hash of the html bytes, resolved pdf options and font size.'''
+        _hash = hashlib.sha256()
+        try:
+            with open(uri, 'rb') as _fh:
+                for _block in iter(lambda: _fh.read(65536), b''):
+                    _hash.update(_block)
+        except OSError:
+            _hash.update(bytes(uri, encoding='utf-8'))
+        _hash.update(bytes(json.dumps(resolveopts(pdfopts, fontsize),
+            sort_keys=True), encoding='utf-8'))
+        _hash.update(bytes(str(fontsize), encoding='utf-8'))
+        return _hash.hexdigest()
+
+    def __fn(self, _key):
+        return os.path.join(self.path, _key+'.pdf')
+
+    def holds(self, pdf_fn):
+        '''True if pdf_fn lives in the cache (renders still in a .tmp file
+           or too large to cache do not).'''
+        return pdf_fn.endswith('.pdf') and \
+            os.path.dirname(os.path.abspath(pdf_fn)) == os.path.abspath(self.path)
+
+    def get(self, _key):
+        '''Return the cached PDF for _key or None.'''
+        _fn = self.__fn(_key)
+        with self.__lock:
+            if os.path.exists(_fn):
+                self.hits += 1
+                os.utime(_fn) # mtime is the LRU clock
+                self.__pinned[_fn] += 1
+                logger.debug("PDF cache hit for %s", _key)
+                return _fn
+            self.misses += 1
+        return None
+
+    def put(self, _key, pdf_fn):
+        '''Move a freshly rendered PDF into the cache and return its new name.
+           A PDF larger than the whole cache is not cached and returned as is.'''
+        if os.path.getsize(pdf_fn) > self.maxsize:
+            logger.debug("%s does not fit in the PDF cache.", pdf_fn)
+            return pdf_fn
+        _fn = self.__fn(_key)
+        with self.__lock:
+            os.replace(pdf_fn, _fn)
+            self.__pinned[_fn] += 1
+        self.evict()
+        return _fn
+
+    def unpin(self, pdf_fn):
+        '''Let a PDF from get() or put() be evicted again.'''
+        with self.__lock:
+            self.__pinned[pdf_fn] -= 1
+            if self.__pinned[pdf_fn] <= 0:
+                del self.__pinned[pdf_fn]
+
+    def evict(self):
+        '''Remove least recently used PDFs that are not pinned
+           until the cache fits in maxsize.'''
+        with self.__lock:
+            _pdfs = []
+            for _name in os.listdir(self.path):
+                _fn = os.path.join(self.path, _name)
+                if _name.endswith('.pdf'):
+                    _stat = os.stat(_fn)
+                    _pdfs.append((_stat.st_mtime, _stat.st_size, _fn))
+            _total = sum(_size for _, _size, _ in _pdfs)
+            for _, _size, _fn in sorted(_pdfs):
+                if _total <= self.maxsize:
+                    break
+                if _fn in self.__pinned:
+                    continue
+                logger.debug("Evicting %s from the PDF cache.", _fn)
+                os.remove(_fn)
+                _total -= _size
+
+    def log(self):
+        '''Log the hit/miss counters.'''
+        logger.info("PDF cache: %s hits, %s misses.", self.hits, self.misses)
+
+def resolveopts(pdfopts, fontsize=None):
+    '''Return a copy of pdfopts with the font size applied.'''
+    pdfopts = dict(pdfopts)
+    if fontsize is not None:
+        pdfopts['minimum-font-size'] = fontsize
+    return pdfopts
+
+@metrics.timed('pdf.render')
+def uritopdf(uri, pdfopts, fontsize=None, tmpdir=None):
+    '''Convert a url to a pdf file'''
+    pdfopts = resolveopts(pdfopts, fontsize)
+    logger.debug(pdfopts)
+    with tempfile.NamedTemporaryFile(suffix='.tmp', dir=tmpdir, delete=False) as _fh:
+        _fn = _fh.name
+    try:
+        logger.info("Saving %s to pdf." , uri)
+        # wkhtmltopdf writes straight to _fn instead of returning the PDF
+        pdfkit.from_file(uri, _fn, options=pdfopts)
+    except OSError:
+        os.remove(_fn)
+        return None
+    if os.path.getsize(_fn) > 5096: # Check here if a real PDF was made
+        return _fn
+    os.remove(_fn)
+    return None
@@ -0,0 +1,139 @@
+'''Poll each feed on its own interval for --daemon.'''
+import time
+import random
+import logging
+import datetime
+import threading
+from .util import hashstring
+from .constants import STRFTIME
+from .instrument import metrics
+
+class Scheduler():
+    '''Run a job per feed whenever it is due and adapt the interval of
+       each feed to how often it publishes. The estimated gap between
+       new entries and the time of the last poll are kept in the
+       'schedule' key of the cache, so a restart picks up where the
+       last daemon left off.'''
+
+    # Poll about twice per expected new entry
+    POLLS_PER_ENTRY = 2
+    # Grow the gap by this much after every poll without new entries
+    BACKOFF = 1.25
+    # Weight of the newest observation of the gap between entries
+    SMOOTHING = 0.5
+    # A batch job also polls its feeds that are due within this many seconds
+    BATCH_AHEAD = 60
+
+    def __init__(self, cache, interval=60, minimum=15, maximum=720, jitter=0.1):
+        self.logger = logging.getLogger(__name__)
+        self.cache = cache
+        self.interval = interval * 60
+        self.minimum = minimum * 60
+        self.maximum = max(maximum, minimum) * 60
+        self.jitter = jitter
+        self.jobs = {}
+        self.batched = set()
+        self.due = {}
+        self.stopping = threading.Event()
+        if not self.cache.haskey('schedule'):
+            self.cache.set({}, 'schedule')
+
+    def __state(self, name):
+        '''Return the saved gap and last poll of feed name.'''
+        if self.cache.haskey('schedule', hashstring(name)):
+            return self.cache.get('schedule', hashstring(name))
+        return {'gap': self.interval * self.POLLS_PER_ENTRY, 'polled': ''}
+
+    def __wait(self, name):
+        '''Seconds to wait before polling feed name again.'''
+        _wait = self.__state(name)['gap'] / self.POLLS_PER_ENTRY
+        _wait = min(self.maximum, max(self.minimum, _wait))
+        return _wait * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def add(self, name, job, batch=False):
+        '''Schedule job, which polls feed name and returns the number of
+           new entries it found. A batch job instead takes a list of names
+           and returns {name: new entries}, so that all due feeds that share
+           it are polled in one call.'''
+        self.jobs[name] = job
+        if batch:
+            self.batched.add(job)
+        _polled = self.__state(name)['polled']
+        if _polled:
+            _last = time.mktime(time.strptime(_polled, STRFTIME))
+            self.due[name] = _last + self.__wait(name)
+        else:
+            # Spread the first polls of new feeds over a few seconds
+            self.due[name] = time.time() + random.uniform(0, 5 * self.jitter * len(self.jobs))
+        return self
+
+    def polled(self, name, new, started):
+        '''Update the estimated gap between entries of feed name from the
+           new entries found in the time since the last poll.'''
+        _state = self.__state(name)
+        _gap = _state['gap']
+        if _state['polled'] and new:
+            _elapsed = started - time.mktime(time.strptime(_state['polled'], STRFTIME))
+            _gap = (1 - self.SMOOTHING) * _gap + self.SMOOTHING * _elapsed / new
+        elif not new:
+            _gap = _gap * self.BACKOFF
+        _gap = min(self.maximum * self.POLLS_PER_ENTRY,
+                   max(self.minimum * self.POLLS_PER_ENTRY, _gap))
+        self.cache.set({'gap': round(_gap),
+                        'polled': datetime.datetime.fromtimestamp(started).strftime(STRFTIME)},
+                       'schedule', hashstring(name))
+        self.due[name] = started + self.__wait(name)
+        self.logger.debug("%s had %s new entries, polling again in %.0f minutes.",
+            name, new, (self.due[name] - started) / 60)
+
+    def __poll(self, job, names):
+        '''Run job for the due feeds names and return {name: new entries}.'''
+        try:
+            if job in self.batched:
+                return job(names) or {}
+            return {names[0]: job() or 0}
+        except Exception as msg: #pylint: disable=broad-except
+            self.logger.error("Error polling %s: %s", ', '.join(names), str(msg))
+            return {}
+
+    def run(self, flush, flushinterval=600):
+        '''Poll due feeds until stop() is called, calling flush
+           at most every flushinterval seconds and once at the end.'''
+        _flushed = time.time()
+        try:
+            while not self.stopping.is_set():
+                _now = time.time()
+                _due = [_name for _name in sorted(self.due, key=self.due.get)
+                        if self.due[_name] <= _now]
+                _done = set()
+                for _name in _due:
+                    if self.stopping.is_set():
+                        break
+                    if _name in _done:
+                        continue
+                    _job = self.jobs[_name]
+                    _names = [_name]
+                    if _job in self.batched:
+                        _names = [_n for _n in sorted(self.due, key=self.due.get)
+                                  if self.jobs[_n] is _job and _n not in _done
+                                  and self.due[_n] <= _now + self.BATCH_AHEAD]
+                    _started = time.time()
+                    _new = self.__poll(_job, _names)
+                    for _n in _names:
+                        metrics.count('schedule.polls')
+                        self.polled(_n, _new.get(_n, 0), _started)
+                    _done.update(_names)
+                if time.time() - _flushed >= flushinterval:
+                    flush()
+                    _flushed = time.time()
+                if self.due:
+                    self.stopping.wait(max(1, min(self.due.values()) - time.time()))
+                else:
+                    self.stopping.wait(flushinterval)
+        finally:
+            flush()
+
+    def stop(self, *args): #pylint: disable=unused-argument
+        '''Stop after the current poll (also works as a signal handler).'''
+        self.logger.info("Stopping the scheduler.")
+        self.stopping.set()
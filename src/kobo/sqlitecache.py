@@ -0,0 +1,332 @@
+'''
+A drop-in replacement for Cache that keeps the cache in an sqlite
+database instead of loading a json file into memory.
+'''
+
+import os
+import copy
+import time
+import json
+import logging
+import sqlite3
+import operator
+import functools
+from .cache import Cache, LinkDigests, dedupe_nested, synchronized
+from .constants import HASH
+from .instrument import metrics
+from .util import hashstring
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS link_feeds (feed TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS links (
+    id INTEGER PRIMARY KEY,
+    feed TEXT NOT NULL,
+    url TEXT NOT NULL,
+    UNIQUE (feed, url));
+CREATE TABLE IF NOT EXISTS cookies (domain TEXT PRIMARY KEY, cookies TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS substack_jail (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    jailed INTEGER NOT NULL,
+    since TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, val TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, val TEXT);
+'''
+
+class SqliteCache(Cache):
+    '''Cache with the same get/set/has/append API stored in sqlite.
+       Links are indexed by (feed hash, url); cookies and substack_jail
+       have their own tables and any other key is stored as json, which
+       is parsed once and written back by save().'''
+
+    def __init__(self, opts):
+        self.db_fn = None
+        self.db = None
+        # Parsed json values of the kv table and the keys set since save()
+        self.kv = {}
+        self.dirty = set()
+        super().__init__(opts)
+
+    def loadcache(self):
+        '''Open the database and migrate the json cache on first use.'''
+        self.logger = logging.getLogger(__name__)
+        if self.opts.dryrun:
+            self.logger.info("Loading cache in dry-run mode.")
+        self.db_fn = os.path.splitext(self.cache_fn)[0]+'.sqlite'
+        self.logger.debug("Opening %s.", self.db_fn)
+        self.db = sqlite3.connect(self.db_fn, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        if self.__meta('migrated') is None:
+            if os.path.exists(self.cache_fn) or os.path.exists(self.journal_fn):
+                self.migrate()
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('migrated', ?)",
+                (self.cache_fn,))
+            if not self.opts.dryrun:
+                self.__writekv()
+                self.db.commit()
+        if self.__meta('links') == HASH:
+            self.compactlinks = True
+        elif self.compactlinks:
+            self.hashlinks()
+        return self
+
+    def migrate(self):
+        '''Copy the contents of the json cache (and its journal) into the database.'''
+        self.logger.warning("Migrating %s to %s.", self.cache_fn, self.db_fn)
+        _json = Cache(self.opts)
+        self.compactlinks = _json.compactlinks
+        self.update(_json.cache)
+        if self.compactlinks:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('links', ?)", (HASH,))
+        self.logger.info("Migrated %s links from %s feeds.",
+            self.__count(), len(_json.cache.get('links', {})))
+
+    def hashlinks(self):
+        '''Replace the urls in the links table with their digests.'''
+        self.logger.warning("Storing the links in %s as digests.", self.db_fn)
+        self.db.executemany("UPDATE OR IGNORE links SET url = ? WHERE id = ?",
+            [(hashstring(_url), _id) for _id, _url
+             in self.db.execute("SELECT id, url FROM links").fetchall()])
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('links', ?)", (HASH,))
+        self.compact()
+
+    def __meta(self, _key):
+        _row = self.db.execute("SELECT val FROM meta WHERE key = ?", (_key,)).fetchone()
+        return None if _row is None else _row[0]
+
+    def __count(self):
+        return self.db.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+
+    def __kv(self, _top):
+        '''The value of a key in the kv table, parsed on first use.'''
+        if _top not in self.kv:
+            _row = self.db.execute("SELECT val FROM kv WHERE key = ?", (_top,)).fetchone()
+            if _row is not None:
+                self.kv[_top] = json.loads(_row[0])
+            elif _top in Cache.cache_template:
+                self.kv[_top] = copy.deepcopy(Cache.cache_template[_top])
+            else:
+                raise KeyError('Key not found in inernal cache.')
+        return self.kv[_top]
+
+    def __writekv(self):
+        '''Write the kv values that were set since the last save.'''
+        self.db.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?)",
+            [(_top, json.dumps(self.kv[_top])) for _top in self.dirty])
+        self.dirty = set()
+
+    @metrics.timed('cache.save')
+    @synchronized
+    def save(self, updated_cache=None):
+        '''Commit pending changes to the database'''
+        if updated_cache:
+            self.update(updated_cache)
+        if self.opts.dryrun:
+            self.logger.info("Dry run, not saving cache.")
+        else:
+            self.__writekv()
+            self.db.commit()
+            self.logger.debug("Cache saved to %s" , self.db_fn)
+
+    @synchronized
+    def compact(self):
+        '''Commit and vacuum the database'''
+        self.save()
+        if not self.opts.dryrun:
+            self.db.execute("VACUUM")
+
+    @synchronized
+    def update(self, updated_cache):
+        '''Replace the contents of the database with a cache dict'''
+        self.db.execute("DELETE FROM kv")
+        self.kv = {}
+        self.dirty = set()
+        for _key in Cache.cache_template:
+            if _key not in updated_cache:
+                self.set(copy.deepcopy(Cache.cache_template[_key]), _key)
+        for _key in updated_cache:
+            self.set(updated_cache[_key], _key)
+
+    @synchronized
+    def get(self, *cache_key):
+        '''Retreive a value from the cache'''
+        _top, _rest = cache_key[0], cache_key[1:]
+        if _top == 'links':
+            if not _rest:
+                _links = {}
+                for (_feed,) in self.db.execute("SELECT feed FROM link_feeds"):
+                    _links[_feed] = self.__links(_feed)
+                return _links
+            if len(_rest) == 1 and self.haskey('links', _rest[0]):
+                return self.__links(_rest[0])
+            raise KeyError('Key not found in inernal cache.')
+        if _top == 'cookies':
+            _cookies = {}
+            for _domain, _val in self.db.execute("SELECT domain, cookies FROM cookies"):
+                _cookies[_domain] = json.loads(_val)
+            _val = _cookies
+        elif _top == 'substack_jail':
+            _row = self.db.execute(
+                "SELECT jailed, since FROM substack_jail WHERE id = 0").fetchone()
+            _val = list(Cache.cache_template['substack_jail']) \
+                if _row is None else [bool(_row[0]), _row[1]]
+        else:
+            _val = self.__kv(_top)
+        try:
+            return functools.reduce(operator.getitem, _rest, _val)
+        except (KeyError, IndexError, TypeError) as err:
+            raise KeyError('Key not found in inernal cache.') from err
+
+    def __links(self, _feed):
+        return [_url for (_url,) in self.db.execute(
+            "SELECT url FROM links WHERE feed = ? ORDER BY id", (_feed,))]
+
+    @synchronized
+    def has(self, cache_var, *cache_key):
+        '''Check if the cache has a key/var'''
+        if cache_key == ('links',):
+            _found = self.haskey('links', cache_var)
+        elif len(cache_key) == 2 and cache_key[0] == 'links':
+            # Like LinkDigests, anything but a url is simply not cached
+            if not isinstance(cache_var, str):
+                _found = False
+            else:
+                if self.compactlinks:
+                    cache_var = hashstring(cache_var)
+                _found = self.db.execute(
+                    "SELECT 1 FROM links WHERE feed = ? AND url = ?",
+                    (cache_key[1], cache_var)).fetchone() is not None
+        elif cache_key == ('cookies',):
+            _found = self.db.execute("SELECT 1 FROM cookies WHERE domain = ?",
+                (cache_var,)).fetchone() is not None
+        else:
+            return super().has(cache_var, *cache_key)
+        metrics.count('cache.hit' if _found else 'cache.miss')
+        return _found
+
+    @synchronized
+    def haskey(self, *cache_key):
+        '''Check if the cache has a key'''
+        if cache_key == ('links',):
+            return True
+        if len(cache_key) == 2 and cache_key[0] == 'links':
+            return self.db.execute("SELECT 1 FROM link_feeds WHERE feed = ?",
+                (cache_key[1],)).fetchone() is not None
+        return super().haskey(*cache_key)
+
+    @synchronized
+    def set(self, cache_var, *cache_key, commit=False):
+        '''Set a value in the cache and save it or not'''
+        self.logger.debug("Setting new cache for key %s", cache_key)
+        _top = cache_key[0]
+        if _top == 'links' and len(cache_key) <= 2:
+            _links = cache_var if len(cache_key) == 1 else {cache_key[1]: cache_var}
+            if len(cache_key) == 1:
+                self.db.execute("DELETE FROM links")
+                self.db.execute("DELETE FROM link_feeds")
+            for _feed in _links:
+                self.db.execute("DELETE FROM links WHERE feed = ?", (_feed,))
+                self.db.execute("INSERT OR IGNORE INTO link_feeds VALUES (?)", (_feed,))
+                self.__insertlinks(_feed, _links[_feed])
+        elif _top == 'cookies' and len(cache_key) <= 2:
+            _cookies = cache_var if len(cache_key) == 1 else {cache_key[1]: cache_var}
+            if len(cache_key) == 1:
+                self.db.execute("DELETE FROM cookies")
+            self.db.executemany("INSERT OR REPLACE INTO cookies VALUES (?, ?)",
+                [(_domain, json.dumps(_cookies[_domain])) for _domain in _cookies])
+        elif _top == 'substack_jail' and len(cache_key) == 1:
+            self.db.execute("INSERT OR REPLACE INTO substack_jail VALUES (0, ?, ?)",
+                (int(bool(cache_var[0])), cache_var[1]))
+        elif _top in ('links', 'cookies', 'substack_jail'):
+            raise KeyError('Cannot set %s that deep in the sqlite cache.' % str(cache_key))
+        elif len(cache_key) == 1:
+            self.kv[_top] = cache_var
+            self.dirty.add(_top)
+        else:
+            try:
+                _node = self.__kv(_top)
+            except KeyError:
+                _node = self.kv[_top] = {}
+            for _key in cache_key[1:-1]:
+                if _key not in _node:
+                    _node[_key] = {}
+                _node = _node[_key]
+            _node[cache_key[-1]] = cache_var
+            self.dirty.add(_top)
+        if commit:
+            self.save()
+
+    def __insertlinks(self, _feed, _urls):
+        if isinstance(_urls, LinkDigests):
+            _urls = list(_urls)
+        elif self.compactlinks:
+            _urls = [hashstring(_url) for _url in _urls]
+        self.db.executemany("INSERT OR IGNORE INTO links (feed, url) VALUES (?, ?)",
+            [(_feed, _url) for _url in _urls])
+
+    @synchronized
+    def append(self, cache_var, *cache_key, commit=False):
+        '''Append values to a list in the cache'''
+        self.logger.debug("Appending {%s:%s}" , str(cache_key), str(cache_var))
+        if not self.haskey(*cache_key):
+            raise KeyError('Cannot append to key that is not in internal cache.')
+        if len(cache_key) == 2 and cache_key[0] == 'links':
+            if not isinstance(cache_var, list):
+                cache_var = [cache_var]
+            self.__insertlinks(cache_key[1], cache_var)
+        else:
+            _val = self.get(*cache_key)
+            if isinstance(cache_var, type(_val)):
+                _val += cache_var
+            elif isinstance(_val, list):
+                _val.append(cache_var)
+            else:
+                self.logger.error('Error trying to append internal cache')
+                raise AttributeError('Cannot append to a %s in internal cache.' % type(_val))
+            self.set(_val, *cache_key)
+        if commit:
+            self.save()
+
+    @synchronized
+    def reset(self, _key):
+        '''Reset a key to default.'''
+        self.logger.warning('Resetting %s key in cache.', _key)
+        time.sleep(5)
+        if _key not in Cache.cache_template:
+            raise AttributeError("Trying to reset a non-standard key from cache.")
+        self.set(copy.deepcopy(Cache.cache_template[_key]), _key, commit=True)
+
+    @synchronized
+    def dedupe(self):
+        '''Deduplicate the json values in the database; links are
+        unique by construction. Returns duplicates removed per key path.'''
+        self.logger.info("Links in %s are already unique.", self.db_fn)
+        _keys = ['cookies'] + sorted(set(self.kv) |
+            {_key for (_key,) in self.db.execute("SELECT key FROM kv")})
+        _deduped = {}
+        for _key in _keys:
+            if _key in self.dedupe_skip:
+                continue
+            _val = self.get(_key)
+            _counts = dedupe_nested(_val, (_key,))
+            if _counts:
+                self.set(_val, _key)
+                _deduped.update(_counts)
+        for _path, _count in _deduped.items():
+            self.logger.info("Removed %s duplicates from %s", _count, _path)
+        self.logger.info("Deduped %s items", sum(_deduped.values()))
+        return _deduped
+
+    @synchronized
+    def cleankey(self, keys_to_compare, *cache_key):
+        '''Compare the stored stored to a list of keys and remove
+        cached keys that are not in the list'''
+        if cache_key != ('links',):
+            super().cleankey(keys_to_compare, *cache_key)
+            return
+        _keep = set(keys_to_compare)
+        for (_feed,) in self.db.execute("SELECT feed FROM link_feeds").fetchall():
+            if _feed not in _keep:
+                self.logger.debug("Removing %s from links.", _feed)
+                self.db.execute("DELETE FROM links WHERE feed = ?", (_feed,))
+                self.db.execute("DELETE FROM link_feeds WHERE feed = ?", (_feed,))
+        self.save()
@@ -0,0 +1,20 @@
+'''Render substacks on several webdrivers at once.'''
+
+import logging
+from .dosubstack import DoSubstack
+
+class SubstackWorkers():
+    '''Build one DoSubstack per worker slot, each with its own webdriver,
+       cookie jar and login state, for the fetch stage of the substack
+       pipeline to run on.'''
+
+    def __init__(self, opts, config, cache, substack, workers=2):
+        self.logger = logging.getLogger(__name__)
+        # The first worker reuses the main DoSubstack, which already
+        # ran the custom logins, and all workers share its driver pool
+        # and throttle.
+        self.substacks = [substack]
+        for _slot in range(1, max(1, workers)):
+            self.substacks.append(DoSubstack(opts, config, cache,
+                substack.driverpool, _slot, customlogins=False,
+                throttle=substack.throttle))
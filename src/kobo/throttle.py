@@ -0,0 +1,102 @@
+'''Rate limit and back off substack domains one at a time.'''
+import time
+import logging
+import datetime
+import threading
+from .constants import STRFTIME
+from .instrument import metrics
+
+class Throttle():
+    '''A token bucket for logins and an exponential backoff per domain,
+       kept in the 'throttle' key of the cache so that they carry over
+       between runs. Domains that answer normally are never slowed down;
+       a CAPTCHA, a 429/503 or a failed login backs off only that domain.'''
+
+    # Logins a domain may do back to back, and seconds to earn another one
+    BURST = 3
+    REFILL = 300
+    # Backoff after the first push back, doubled on every next one
+    BACKOFF_MIN = 60
+    BACKOFF_MAX = 6 * 3600
+
+    def __init__(self, cache, maxwait=30):
+        self.logger = logging.getLogger(__name__)
+        self.cache = cache
+        self.maxwait = maxwait
+        self.__lock = threading.Lock()
+        if not self.cache.haskey('throttle'):
+            self.cache.set({}, 'throttle')
+
+    def __state(self, domain, now):
+        '''Return a copy of the state of domain with the tokens refilled
+           up to now; callers store changes with cache.set.'''
+        if self.cache.haskey('throttle', domain):
+            _state = dict(self.cache.get('throttle', domain))
+        else:
+            _state = {'tokens': self.BURST, 'updated': '', 'backoff': 0, 'until': ''}
+        if _state['updated']:
+            _elapsed = now - time.mktime(time.strptime(_state['updated'], STRFTIME))
+            _state['tokens'] = min(self.BURST, _state['tokens'] + _elapsed / self.REFILL)
+        _state['updated'] = datetime.datetime.fromtimestamp(now).strftime(STRFTIME)
+        return _state
+
+    def delay(self, domain, login=False):
+        '''Seconds before domain may be loaded again (or logged in to).'''
+        _now = time.time()
+        with self.__lock:
+            _state = self.__state(domain, _now)
+        _delay = 0
+        if _state['until']:
+            _delay = time.mktime(time.strptime(_state['until'], STRFTIME)) - _now
+        if login and _state['tokens'] < 1:
+            _delay = max(_delay, (1 - _state['tokens']) * self.REFILL)
+        return max(0, _delay)
+
+    def wait(self, domain, login=False):
+        '''Sleep until domain may be loaded (and take a login token) and
+           return True, or return False at once if that is more than
+           maxwait seconds away, so the domain is skipped this run.'''
+        _delay = self.delay(domain, login)
+        if _delay > self.maxwait:
+            self.logger.info("Backing off %s for another %.0f minutes.",
+                domain, _delay / 60)
+            metrics.count('throttle.skipped')
+            return False
+        if _delay > 0:
+            self.logger.debug("Waiting %.0f s for %s.", _delay, domain)
+            metrics.add('throttle.wait', _delay)
+            time.sleep(_delay)
+        if login:
+            with self.__lock:
+                _state = self.__state(domain, time.time())
+                _state['tokens'] = max(0, _state['tokens'] - 1)
+                self.cache.set(_state, 'throttle', domain)
+        return True
+
+    def pushback(self, domain, reason, retry_after=None):
+        '''domain showed a CAPTCHA, refused a login or asked us to slow
+           down: back off twice as long as last time, and at least retry_after s.'''
+        _now = time.time()
+        with self.__lock:
+            _state = self.__state(domain, _now)
+            _state['backoff'] = min(self.BACKOFF_MAX,
+                max(self.BACKOFF_MIN, _state['backoff'] * 2))
+            _wait = max(_state['backoff'], retry_after or 0)
+            _state['until'] = datetime.datetime.fromtimestamp(_now + _wait).strftime(STRFTIME)
+            _state['tokens'] = 0
+            self.cache.set(_state, 'throttle', domain)
+        self.logger.warning("%s pushed back (%s), backing off for %.0f minutes.",
+            domain, reason, _wait / 60)
+        metrics.count('throttle.pushback')
+
+    def success(self, domain):
+        '''domain answered normally, halve its backoff.'''
+        with self.__lock:
+            if not self.cache.haskey('throttle', domain):
+                return
+            _state = self.__state(domain, time.time())
+            if not _state['backoff']:
+                return
+            _state['backoff'] = _state['backoff'] // 2 \
+                if _state['backoff'] > self.BACKOFF_MIN else 0
+            self.cache.set(_state, 'throttle', domain)
@@ -4,23 +4,24 @@ import sys
 import os
 import logging
 import tempfile
-import urllib
+import urllib.request
+import urllib.error
 import hashlib
 from .constants import HASH #pylint: disable=E0401
 
 logger = logging.getLogger(__name__)
 
-try:
-    import pushover
-except ImportError as msg:
-    logger.error("Error loading pacakge %s" , str(msg))
-    sys.exit()
-
 def sendpushover(po_msg, device, img=None):
     '''Send a pushover message with or without an image'''
     if not po_msg:
         logger.warning("Passed empty message to pushover.")
         return
+    # Only substack logins send messages, so don't import it for every run
+    try:
+        import pushover #pylint: disable=import-outside-toplevel
+    except ImportError as msg:
+        logger.error("Error loading pacakge %s" , str(msg))
+        return
     client = pushover.Client(device=device)
     po_title=os.path.basename(sys.argv[0])
     if img:
@@ -32,7 +33,7 @@ def sendpushover(po_msg, device, img=None):
         client.send_message(po_msg,title=po_title,sound='none',html='1')
     logger.debug('Sent a pushover message.')
 
-def checkurl(uri):
+def checkurl(uri, timeout=10):
     '''See if a URL still exists.'''
     req = urllib.request.Request(
             uri,
@@ -46,12 +47,10 @@ def checkurl(uri):
             }
                 )
     try:
-        _res = urllib.request.urlopen(req)
-        if _res.getcode() == 200:
-            valid = True
-    except urllib.error.HTTPError:
+        with urllib.request.urlopen(req, timeout=timeout) as _res:
+            return _res.getcode() == 200
+    except (urllib.error.URLError, OSError):
         return False
-    return valid
 
 def parseloginurls(substacks):
     '''Parse substack login urls and make them neat enough
@@ -73,6 +72,15 @@ def hashstring(unhashed_string):
     _hash.update(bytes(unhashed_string, encoding='utf-8'))
     return _hash.hexdigest()
 
+def contenthash(filename, blocksize=4*1024*1024):
+    '''Return the Dropbox content_hash of a file: the SHA-256 of
+    the concatenated SHA-256 digests of each 4 MB block.'''
+    _hash = hashlib.sha256()
+    with open(filename, 'rb') as _fh:
+        for _block in iter(lambda: _fh.read(blocksize), b''):
+            _hash.update(hashlib.sha256(_block).digest())
+    return _hash.hexdigest()
+
 def cleancache(cache, config):
     '''Clean the links key in the cache.'''
     logger.info("Cleaning the links key in the cache.")
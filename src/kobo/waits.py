@@ -0,0 +1,90 @@
+'''Explicit readiness waits for the webdriver instead of fixed sleeps.'''
+
+import os
+import sys
+import time
+import logging
+import contextlib
+import collections
+from .instrument import metrics
+
+try:
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.common.exceptions import TimeoutException
+    from selenium.common.exceptions import WebDriverException
+except ImportError as msg:
+    print("Error loading pacakge %s" , str(msg))
+    sys.exit()
+
+logger = logging.getLogger(__name__)
+
+POLL = 0.1 # seconds
+
+def wait_until(driver, condition, timeout, message=''):
+    '''Poll condition(driver) until it is truthy and return its value,
+       or return None after timeout seconds.'''
+    try:
+        return WebDriverWait(driver, timeout, poll_frequency=POLL).until(
+            condition, message)
+    except TimeoutException:
+        logger.debug("Timed out after %s s waiting for %s", timeout, message or condition)
+        return None
+
+def document_ready(driver):
+    '''True once the browser has finished loading the current document.'''
+    try:
+        return driver.execute_script('return document.readyState;') == 'complete'
+    except WebDriverException:
+        return False
+
+def wait_ready(driver, timeout):
+    '''Wait for document.readyState to be complete.'''
+    return bool(wait_until(driver, document_ready, timeout, 'document ready'))
+
+def wait_for_element(driver, timeout, *locators):
+    '''Wait until one of the (By, value) locators matches and return
+       the first matching element, or None.'''
+    def _present(_driver):
+        for _by, _value in locators:
+            _found = _driver.find_elements(_by, _value)
+            if _found:
+                return _found[0]
+        return False
+    return wait_until(driver, _present, timeout, 'element %s' % str(locators))
+
+def wait_title(driver, timeout, predicate):
+    '''Wait until predicate(lowercase page title) is true.'''
+    return bool(wait_until(driver,
+        lambda _driver: predicate(_driver.title.lower()), timeout, 'title'))
+
+def wait_for_exit(command, timeout):
+    '''Wait until os command (e.g., pgrep) stops succeeding.'''
+    _until = time.time() + timeout
+    while time.time() < _until:
+        if os.system(command) != 0:
+            return True
+        time.sleep(POLL)
+    return False
+
+class PhaseTimer():
+    '''Collect wall-clock timings per phase, e.g., per webdriver step.
+       Phases are also recorded in the run metrics as substack.<phase>.'''
+
+    def __init__(self):
+        self.timings = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def __call__(self, phase):
+        _start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[phase].append(time.time() - _start)
+            metrics.add('substack.'+phase, self.timings[phase][-1])
+
+    def log(self, _logger=None):
+        '''Log count, mean and max per phase.'''
+        _logger = _logger or logger
+        for _phase, _times in sorted(self.timings.items()):
+            _logger.info("%-10s %4s x  mean %.2f s  max %.2f s  total %.1f s",
+                _phase, len(_times), sum(_times)/len(_times), max(_times), sum(_times))
@@ -0,0 +1,15 @@
+'''Shared fixtures. The tests run offline and need neither a browser,
+wkhtmltopdf nor any credentials.'''
+import os
+import sys
+import types
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+@pytest.fixture
+def opts(tmp_path):
+    '''The options the cache classes read, with the cache in tmp_path.'''
+    return types.SimpleNamespace(cachedir=str(tmp_path), dryrun=False,
+        compactlinks=False)
@@ -0,0 +1,31 @@
+'''Dedupe removes repeated list items at any depth in one pass.'''
+from kobo.cache import Cache, dedupe_nested
+
+def test_dedupe_nested_keeps_first_occurrences():
+    _val = {'a': [3, 1, 3, 2, 1], 'b': {'c': ['x', 'x'], 'd': 'xx'}}
+    assert dedupe_nested(_val, ('top',)) == {'top/a': 2, 'top/b/c': 1}
+    assert _val == {'a': [3, 1, 2], 'b': {'c': ['x'], 'd': 'xx'}}
+
+def test_dedupe_nested_compares_unhashable_items_by_value():
+    _val = [{'name': 'a', 'v': 1}, {'v': 1, 'name': 'a'}, ['x'], ['x'], {'name': 'b'}]
+    assert dedupe_nested(_val) == {'': 2}
+    assert _val == [{'name': 'a', 'v': 1}, ['x'], {'name': 'b'}]
+
+def test_dedupe_nested_leaves_unique_lists_alone():
+    _list = ['a', 'b']
+    assert dedupe_nested({'k': _list}) == {}
+    assert _list == ['a', 'b']
+
+def test_cache_dedupe(opts):
+    cache = Cache(opts)
+    cache.set(['a', 'b', 'a'], 'links', 'f')
+    cache.set([False, '2021-01-01T00:00:00', False], 'substack_jail')
+    cache.set({'x': [['c', 1], ['c', 1]]}, 'cookies')
+    assert cache.dedupe() == {'links/f': 1, 'cookies/x': 1}
+    assert cache.get('links', 'f') == ['a', 'b']
+    # substack_jail is a pair, not a set of values
+    assert cache.get('substack_jail') == [False, '2021-01-01T00:00:00', False]
+    # The set index follows the deduped lists
+    cache.append('c', 'links', 'f')
+    assert cache.has('c', 'links', 'f')
+    assert cache.dedupe() == {}
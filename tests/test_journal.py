@@ -0,0 +1,66 @@
+'''The json cache is a snapshot plus a journal of the operations since.'''
+import os
+import json
+from kobo.cache import Cache
+
+def test_replay_without_save(opts):
+    cache = Cache(opts)
+    cache.set(['a'], 'links', 'f')
+    cache.append('b', 'links', 'f')
+    cache.set({'etag': 'x'}, 'feeds', 'f')
+    # No save(): the process "crashes" here
+    reloaded = Cache(opts)
+    assert reloaded.get('links', 'f') == ['a', 'b']
+    assert reloaded.has('b', 'links', 'f')
+    assert reloaded.get('feeds', 'f') == {'etag': 'x'}
+
+def test_compact_truncates_journal(opts):
+    cache = Cache(opts)
+    cache.journal_max = 3
+    cache.set(['l0'], 'links', 'f')
+    for _i in range(1, 5):
+        cache.append_unique('l%s' % _i, 'links', 'f')
+    cache.save()
+    assert cache.journaled == 0
+    with open(cache.journal_fn) as _fh:
+        assert json.loads(_fh.readline()) == {'gen': cache.generation}
+        assert not _fh.read()
+    assert Cache(opts).get('links', 'f') == ['l%s' % _i for _i in range(5)]
+
+def test_truncated_entry_is_ignored(opts):
+    cache = Cache(opts)
+    cache.set(['a'], 'links', 'f')
+    cache.save()
+    with open(cache.journal_fn, 'at') as _fh:
+        _fh.write('{"op": "append", "key": ["links", "f"], "va')
+    reloaded = Cache(opts)
+    assert reloaded.get('links', 'f') == ['a']
+    assert reloaded.needs_compact
+
+def test_stale_journal_is_not_replayed(opts):
+    cache = Cache(opts)
+    cache.set(['a'], 'links', 'f')
+    cache.compact()
+    with open(cache.journal_fn, 'wt') as _fh:
+        _fh.write(json.dumps({'gen': cache.generation - 1})+'\n')
+        _fh.write(json.dumps({'op': 'append', 'key': ['links', 'f'], 'val': 'old'})+'\n')
+    assert Cache(opts).get('links', 'f') == ['a']
+
+def test_writes_after_dedupe_survive_a_crash(opts):
+    cache = Cache(opts)
+    cache.set(['a', 'a'], 'links', 'f')
+    cache.save()
+    assert cache.dedupe() == {'links/f': 1}
+    cache.append('b', 'links', 'f')
+    cache.set({'etag': 'y'}, 'feeds', 'f')
+    reloaded = Cache(opts)
+    assert reloaded.get('links', 'f') == ['a', 'b']
+    assert reloaded.get('feeds', 'f') == {'etag': 'y'}
+
+def test_dryrun_writes_nothing(opts):
+    opts.dryrun = True
+    cache = Cache(opts)
+    cache.set(['a'], 'links', 'f')
+    cache.save()
+    assert not os.path.exists(cache.cache_fn)
+    assert not os.path.exists(cache.journal_fn)
@@ -0,0 +1,45 @@
+'''Compact links keep only the digests of the urls.'''
+import json
+from kobo.cache import Cache, LinkDigests, jsondefault, jsonhook
+from kobo.util import hashstring
+
+def test_membership():
+    _links = LinkDigests(['https://a.substack.com/p/one'])
+    _links.append('https://a.substack.com/p/two')
+    _links += ['https://a.substack.com/p/three']
+    assert 'https://a.substack.com/p/two' in _links
+    assert 'https://a.substack.com/p/four' not in _links
+    assert len(_links) == 3
+    assert hashstring('https://a.substack.com/p/one') in set(_links)
+
+def test_values_that_are_not_urls_are_not_in_it():
+    _links = LinkDigests(['a'])
+    assert None not in _links
+    assert {} not in _links
+    assert 1 not in _links
+
+def test_json_round_trip():
+    _links = LinkDigests(['a', 'b'])
+    _loaded = json.loads(json.dumps({'f': _links}, default=jsondefault),
+        object_hook=jsonhook)['f']
+    assert isinstance(_loaded, LinkDigests)
+    assert _loaded.digests == _links.digests
+
+def test_cache_converts_and_stays_compact(opts):
+    cache = Cache(opts)
+    cache.set(['a', 'b'], 'links', 'f')
+    cache.save()
+    opts.compactlinks = True
+    compact = Cache(opts)
+    assert isinstance(compact.get('links', 'f'), LinkDigests)
+    assert compact.has('a', 'links', 'f')
+    compact.append('c', 'links', 'f')
+    compact.set(['d'], 'links', 'g')
+    compact.save()
+    # Once compact, the cache stays compact without the option
+    opts.compactlinks = False
+    reloaded = Cache(opts)
+    assert reloaded.compactlinks
+    assert all(reloaded.has(_link, 'links', 'f') for _link in 'abc')
+    assert reloaded.has('d', 'links', 'g')
+    assert not reloaded.has(None, 'links', 'f')
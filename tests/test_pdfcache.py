@@ -0,0 +1,87 @@
+'''PdfCache keeps rendered PDFs by content hash with LRU eviction.'''
+import os
+import pytest
+from kobo.render import PdfCache, PdfRenderer
+
+KB = 1024
+
+@pytest.fixture
+def pdfcache(tmp_path):
+    '''A cache of 1 MB.'''
+    return PdfCache(str(tmp_path), maxsize=1)
+
+def rendered(pdfcache, name, size):
+    '''A fake render in a temp file next to the cache.'''
+    _fn = os.path.join(pdfcache.path, name+'.tmp')
+    with open(_fn, 'wb') as _fh:
+        _fh.write(b'x' * size)
+    return _fn
+
+def age(_fn, seconds):
+    '''Make _fn look least recently used.'''
+    _mtime = os.path.getmtime(_fn) - seconds
+    os.utime(_fn, (_mtime, _mtime))
+
+def test_key_depends_on_html_options_and_fontsize(tmp_path, pdfcache):
+    _html = tmp_path / 'a.html'
+    _html.write_text('<p>a</p>')
+    _key = pdfcache.key(str(_html), {'page-size': 'A6'}, '32')
+    assert _key == pdfcache.key(str(_html), {'page-size': 'A6'}, '32')
+    assert _key != pdfcache.key(str(_html), {'page-size': 'A6'}, '30')
+    assert _key != pdfcache.key(str(_html), {'page-size': 'A5'}, '32')
+    _html.write_text('<p>b</p>')
+    assert _key != pdfcache.key(str(_html), {'page-size': 'A6'}, '32')
+
+def test_get_counts_hits_and_misses(pdfcache):
+    assert pdfcache.get('a') is None
+    _fn = pdfcache.put('a', rendered(pdfcache, 'a', KB))
+    assert pdfcache.get('a') == _fn
+    assert (pdfcache.hits, pdfcache.misses) == (1, 1)
+
+def test_evicts_least_recently_used(pdfcache):
+    _old = pdfcache.put('old', rendered(pdfcache, 'old', 400 * KB))
+    pdfcache.unpin(_old)
+    age(_old, 60)
+    _mid = pdfcache.put('mid', rendered(pdfcache, 'mid', 400 * KB))
+    pdfcache.unpin(_mid)
+    age(_mid, 30)
+    _new = pdfcache.put('new', rendered(pdfcache, 'new', 400 * KB))
+    assert not os.path.exists(_old)
+    assert os.path.exists(_mid) and os.path.exists(_new)
+
+def test_pinned_pdfs_are_not_evicted(pdfcache):
+    _hit = pdfcache.put('hit', rendered(pdfcache, 'hit', 600 * KB))
+    pdfcache.unpin(_hit)
+    age(_hit, 60)
+    assert pdfcache.get('hit') == _hit
+    age(_hit, 60)
+    # Another render thread fills the cache while _hit waits for upload
+    _new = pdfcache.put('new', rendered(pdfcache, 'new', 600 * KB))
+    assert os.path.exists(_hit) and os.path.exists(_new)
+    pdfcache.unpin(_hit)
+    pdfcache.unpin(_new)
+    pdfcache.evict()
+    assert not os.path.exists(_hit) and os.path.exists(_new)
+
+def test_pdfs_larger_than_the_cache_are_not_cached(pdfcache):
+    _tmp = rendered(pdfcache, 'big', 2048 * KB)
+    assert pdfcache.put('big', _tmp) == _tmp
+    assert not pdfcache.holds(_tmp)
+    PdfRenderer(pdfcache).release(_tmp)
+    assert not os.path.exists(_tmp)
+
+def test_renderer_renders_once(monkeypatch, tmp_path, pdfcache):
+    _renders = []
+    def _uritopdf(uri, pdfopts, fontsize=None, tmpdir=None): #pylint: disable=unused-argument
+        _renders.append(uri)
+        return rendered(pdfcache, 'r%s' % len(_renders), KB)
+    monkeypatch.setattr('kobo.render.uritopdf', _uritopdf)
+    _html = tmp_path / 'a.html'
+    _html.write_text('<p>a</p>')
+    renderer = PdfRenderer(pdfcache)
+    _first = renderer.render(str(_html), {}, '32')
+    renderer.release(_first)
+    _second = renderer.render(str(_html), {}, '32')
+    renderer.release(_second)
+    assert _first == _second and os.path.exists(_first)
+    assert _renders == [str(_html)]
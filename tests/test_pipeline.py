@@ -0,0 +1,40 @@
+'''Pipeline runs items through stages connected by bounded queues.'''
+import threading
+from kobo.pipeline import Pipeline
+
+def test_items_pass_every_stage():
+    pipeline = Pipeline(queuesize=2)
+    pipeline.stage('double', lambda _i: [_i * 2], workers=3)
+    pipeline.stage('split', lambda _i: (_i + _n for _n in (0, 1)), workers=2)
+    assert sorted(pipeline.run(range(20))) == sorted(
+        _i * 2 + _n for _i in range(20) for _n in (0, 1))
+
+def test_errors_drop_only_the_failing_item():
+    def _stage(_i):
+        if _i == 3:
+            raise ValueError('bad item')
+        return [_i]
+    pipeline = Pipeline(queuesize=1)
+    pipeline.stage('check', _stage, workers=2)
+    pipeline.stage('last', lambda _i: None if _i == 5 else [_i])
+    assert sorted(pipeline.run(range(8))) == [0, 1, 2, 4, 6, 7]
+
+def test_one_function_per_worker():
+    _threads = {}
+    def _worker(name):
+        def _stage(_i):
+            _threads.setdefault(name, set()).add(threading.current_thread().name)
+            return [(name, _i)]
+        return _stage
+    pipeline = Pipeline()
+    pipeline.stage('fetch', [_worker('a'), _worker('b')])
+    _results = pipeline.run(range(10))
+    assert sorted(_i for _, _i in _results) == list(range(10))
+    assert all(len(_names) == 1 for _names in _threads.values())
+
+def test_empty_run_and_rerun():
+    pipeline = Pipeline()
+    pipeline.stage('first', lambda _i: [_i])
+    pipeline.stage('second', lambda _i: [_i], workers=2)
+    assert pipeline.run([]) == []
+    assert pipeline.run([1]) == [1]
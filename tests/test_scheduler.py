@@ -0,0 +1,71 @@
+'''Scheduler adapts the poll interval of each feed to how often it publishes.'''
+import time
+from kobo.cache import Cache
+from kobo.scheduler import Scheduler
+from kobo.util import hashstring
+
+def scheduler(opts, **kwargs):
+    '''A scheduler without jitter: 60 min default, 15 to 720 min.'''
+    return Scheduler(Cache(opts), jitter=0, **kwargs)
+
+def gap(sched, name):
+    '''The estimated gap between entries of name in minutes.'''
+    return sched.cache.get('schedule', hashstring(name))['gap'] / 60
+
+def test_quiet_feeds_back_off_until_the_maximum(opts):
+    sched = scheduler(opts)
+    _now = time.time()
+    sched.add('quiet', lambda: 0)
+    sched.polled('quiet', 0, _now)
+    assert gap(sched, 'quiet') == 120 * Scheduler.BACKOFF
+    for _ in range(50):
+        sched.polled('quiet', 0, _now)
+    assert gap(sched, 'quiet') == 720 * Scheduler.POLLS_PER_ENTRY
+    assert sched.due['quiet'] - _now == 720 * 60
+
+def test_busy_feeds_are_polled_more_often(opts):
+    sched = scheduler(opts)
+    _now = time.time()
+    sched.add('busy', lambda: 0)
+    sched.polled('busy', 1, _now - 3600)
+    # 6 new entries in the hour since the last poll: one every 10 minutes
+    sched.polled('busy', 6, _now)
+    assert gap(sched, 'busy') == round((0.5 * 120 * 60 + 0.5 * 600)) / 60
+    for _ in range(10):
+        sched.polled('busy', 100, _now)
+    assert gap(sched, 'busy') == 15 * Scheduler.POLLS_PER_ENTRY
+    assert sched.due['busy'] - _now == 15 * 60
+
+def test_schedule_survives_a_restart(opts):
+    sched = scheduler(opts)
+    _now = time.time()
+    sched.add('feed', lambda: 0)
+    sched.polled('feed', 0, _now)
+    sched.cache.save()
+    restarted = scheduler(opts)
+    restarted.add('feed', lambda: 0)
+    # Saved to the second, so due within a second of the first scheduler
+    assert abs(restarted.due['feed'] - sched.due['feed']) <= 1
+
+def test_run_batches_due_feeds_and_survives_errors(opts):
+    sched = scheduler(opts)
+    _calls = []
+    def _batch(names):
+        _calls.append(sorted(names))
+        return {_name: 1 for _name in names}
+    def _broken():
+        _calls.append('broken')
+        raise RuntimeError('feed is down')
+    for _name in ('a', 'b', 'c'):
+        sched.add(_name, _batch, batch=True)
+    sched.add('broken', _broken)
+    _flushes = []
+    def _flush():
+        _flushes.append(True)
+        sched.stop()
+    for _name in sched.due:
+        sched.due[_name] = time.time() - 1
+    sched.run(_flush, flushinterval=0)
+    assert sorted(_calls, key=str) == [['a', 'b', 'c'], 'broken']
+    assert _flushes
+    assert gap(sched, 'a') < gap(sched, 'broken')
@@ -0,0 +1,65 @@
+'''SqliteCache keeps the Cache API on top of an sqlite database.'''
+from kobo.cache import Cache
+from kobo.sqlitecache import SqliteCache
+
+def test_migrates_snapshot_and_journal(opts):
+    cache = Cache(opts)
+    cache.set(['a', 'b'], 'links', 'f')
+    cache.set('2021-01-01', 'dropbox', 'listed')
+    cache.save()
+    cache.compact()
+    cache.append('c', 'links', 'f')
+    cache.set({'etag': 'x'}, 'feeds', 'f')
+    sqlite = SqliteCache(opts)
+    assert sqlite.get('links', 'f') == ['a', 'b', 'c']
+    assert sqlite.has('c', 'links', 'f')
+    assert sqlite.get('feeds', 'f') == {'etag': 'x'}
+    assert sqlite.get('dropbox') == {'listed': '2021-01-01', 'files': {}}
+
+def test_json_keys_are_written_on_save(opts):
+    cache = SqliteCache(opts)
+    for _i in range(100):
+        cache.set([True, 'now'], 'linkcheck', 'h%s' % _i)
+    cache.set({'name': 'x.pdf'}, 'dropbox', 'files', '/kobo/x.pdf')
+    assert cache.haskey('linkcheck', 'h99')
+    cache.save()
+    reloaded = SqliteCache(opts)
+    assert len(reloaded.get('linkcheck')) == 100
+    assert reloaded.get('dropbox', 'files', '/kobo/x.pdf') == {'name': 'x.pdf'}
+    assert not reloaded.haskey('linkcheck', 'h100')
+
+def test_unsaved_json_keys_are_lost_like_uncommitted_rows(opts):
+    cache = SqliteCache(opts)
+    cache.set({'etag': 'x'}, 'feeds', 'f')
+    assert not SqliteCache(opts).haskey('feeds', 'f')
+
+def test_update_and_reset_leave_the_template_alone(opts, monkeypatch):
+    # reset() gives the user five seconds to change their mind
+    monkeypatch.setattr('kobo.sqlitecache.time.sleep', lambda _s: None)
+    cache = SqliteCache(opts)
+    _updated = {'links': {'f': ['a']}}
+    cache.update(_updated)
+    assert list(_updated) == ['links']
+    cache.set({'name': 'x.pdf'}, 'dropbox', 'files', 'x')
+    cache.reset('dropbox')
+    cache.set({'name': 'y.pdf'}, 'dropbox', 'files', 'y')
+    assert Cache.cache_template['dropbox'] == {'listed': '', 'files': {}}
+
+def test_has_ignores_values_that_are_not_urls(opts):
+    cache = SqliteCache(opts)
+    cache.set(['a'], 'links', 'f')
+    assert not cache.has(None, 'links', 'f')
+    assert not cache.has({}, 'links', 'f')
+    cache.save()
+    opts.compactlinks = True
+    compact = SqliteCache(opts)
+    assert compact.has('a', 'links', 'f')
+    assert not compact.has(None, 'links', 'f')
+
+def test_cleankey_drops_feeds(opts):
+    cache = SqliteCache(opts)
+    cache.set(['a'], 'links', 'f')
+    cache.set(['b'], 'links', 'g')
+    cache.cleankey(['g'], 'links')
+    assert not cache.haskey('links', 'f')
+    assert cache.get('links') == {'g': ['b']}
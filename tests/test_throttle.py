@@ -0,0 +1,66 @@
+'''Throttle rate limits logins and backs off domains that push back.'''
+import time
+import datetime
+import pytest
+from kobo.constants import STRFTIME
+from kobo.cache import Cache
+from kobo.throttle import Throttle
+
+@pytest.fixture
+def throttle(opts, monkeypatch):
+    '''A throttle that records its sleeps instead of sleeping.'''
+    _throttle = Throttle(Cache(opts), maxwait=30)
+    _throttle.slept = []
+    monkeypatch.setattr('kobo.throttle.time.sleep', _throttle.slept.append)
+    return _throttle
+
+def test_domains_that_answer_are_not_slowed_down(throttle):
+    for _ in range(10):
+        assert throttle.wait('a.substack.com')
+        throttle.success('a.substack.com')
+    assert throttle.slept == []
+    assert not throttle.cache.haskey('throttle', 'a.substack.com')
+
+def test_logins_use_up_the_burst(throttle):
+    for _ in range(Throttle.BURST):
+        assert throttle.wait('a.substack.com', login=True)
+    assert throttle.delay('a.substack.com', login=True) > Throttle.REFILL - 5
+    # More than maxwait away: skip the domain this run
+    assert not throttle.wait('a.substack.com', login=True)
+    assert throttle.delay('a.substack.com') == 0
+    assert throttle.delay('b.substack.com', login=True) == 0
+
+def test_pushback_doubles_up_to_the_maximum(throttle):
+    _backoffs = []
+    for _ in range(12):
+        throttle.pushback('a.substack.com', 'CAPTCHA')
+        _backoffs.append(throttle.cache.get('throttle', 'a.substack.com')['backoff'])
+    assert _backoffs[:3] == [Throttle.BACKOFF_MIN, 2 * Throttle.BACKOFF_MIN,
+                             4 * Throttle.BACKOFF_MIN]
+    assert _backoffs[-1] == Throttle.BACKOFF_MAX
+    assert not throttle.wait('a.substack.com')
+    assert throttle.wait('b.substack.com')
+
+def test_retry_after_and_success(throttle):
+    throttle.pushback('a.substack.com', 'HTTP 429', retry_after=20)
+    assert throttle.delay('a.substack.com') > 55
+    throttle.pushback('a.substack.com', 'HTTP 429')
+    throttle.success('a.substack.com')
+    assert throttle.cache.get('throttle', 'a.substack.com')['backoff'] == Throttle.BACKOFF_MIN
+    throttle.success('a.substack.com')
+    assert throttle.cache.get('throttle', 'a.substack.com')['backoff'] == 0
+
+def test_state_is_only_changed_through_cache_set(throttle):
+    throttle.pushback('a.substack.com', 'CAPTCHA')
+    _stored = dict(throttle.cache.get('throttle', 'a.substack.com'))
+    # An hour ago, so that delay() refills tokens in its copy
+    _stored['updated'] = datetime.datetime.fromtimestamp(
+        time.time() - 3600).strftime(STRFTIME)
+    throttle.cache.set(dict(_stored), 'throttle', 'a.substack.com')
+    throttle.delay('a.substack.com', login=True)
+    assert throttle.cache.get('throttle', 'a.substack.com') == _stored
+
+def test_state_carries_over_to_the_next_run(opts, throttle):
+    throttle.pushback('a.substack.com', 'login failed')
+    throttle.cache.save()
+    assert not Throttle(Cache(opts)).wait('a.substack.com')